@@ -0,0 +1,94 @@
+# On-disk cache of decoded wave files and their division spectra (see fft.cached_samples and
+# fft.cached_spectra). Used by fft.py, batch.py and generation.py, so it runs under Python 2 and 3
+
+from __future__ import division, print_function
+import os
+import hashlib
+import binascii
+import tempfile
+import numpy as np
+
+# Arrays stored as .npy files in a directory, named by a hash of their key and loaded memory
+# mapped. When the files take more than max_bytes, the least recently used ones are removed.
+# Files are written under a temporary name and renamed, so processes can share a directory
+class AnalysisCache(object):
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.content_hashes = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # file of a key, a tuple of strings and numbers. Floats are written with repr, which gives
+    # every digit and is the same in Python 2 and 3 (str rounds to 12 digits in Python 2), so
+    # both name it the same
+    def path(self, key):
+        key_text = '|'.join(repr(float(part)) if isinstance(part, float) else str(part) for part in key)
+        if not isinstance(key_text, bytes):
+            key_text = key_text.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key_text).hexdigest() + '.npy')
+
+    # the array stored under key, or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            # the modification time of a file is when it was last used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return array
+
+    # stores array under key and returns it
+    def put(self, key, array):
+        path = self.path(key)
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.rename(temp_path, path)
+        self.evict()
+        return array
+
+    # removes the least recently used files until the rest fit in max_bytes
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            # files being written are not entries yet
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # another process removed it first
+                pass
+            total -= size
+
+    # sha1 of the contents of a file. Remembered in the cache by path, size and modification
+    # time, so an unchanged file is not read again
+    def content_hash(self, file_name):
+        stat = os.stat(file_name)
+        key = ('content_hash', os.path.abspath(file_name), stat.st_size, stat.st_mtime)
+        if key in self.content_hashes:
+            return self.content_hashes[key]
+        digest = self.get(key)
+        if digest is None:
+            content_hash = hashlib.sha1()
+            with open(file_name, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    content_hash.update(block)
+            digest = self.put(key, np.frombuffer(content_hash.digest(), dtype=np.uint8))
+        self.content_hashes[key] = binascii.hexlify(np.asarray(digest).tobytes()).decode('ascii')
+        return self.content_hashes[key]
@@ -0,0 +1,170 @@
+# Batch FFT note recognition of many wave files on one process pool
+# Writes the notes of every file as a JSON line or CSV row, in the order of the files
+
+from __future__ import division, print_function
+import os
+import sys
+import csv
+import json
+import signal
+import argparse
+import traceback
+from collections import OrderedDict, deque
+from multiprocessing import Pool, cpu_count
+from fft import analyse_file, export_notes, window_functions
+from metrics import PhaseTimer
+from analysis_cache import AnalysisCache
+
+# analysis cache of this process, set up by init_worker
+analysis_cache = None
+
+# Ignore KeyboardInterrupt in pool, the main process stops the batch
+def init_worker(cache_directory=None, cache_bytes=0):
+    global analysis_cache
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cache_directory is not None:
+        analysis_cache = AnalysisCache(cache_directory, cache_bytes)
+
+# The (file, bpm, divisions, voices) jobs of a directory of wave files or of a manifest: a CSV
+# file with a header or a JSON lines file, with a file column and optionally bpm, divisions
+# and voices columns. Missing values come from defaults, and files are relative to the manifest
+def read_jobs(source, defaults):
+    if os.path.isdir(source):
+        rows = [{'file': os.path.join(source, name)} for name in sorted(os.listdir(source)) if name.lower().endswith('.wav')]
+    else:
+        with open(source) as f:
+            if source.lower().endswith('.csv'):
+                rows = list(csv.DictReader(f))
+            else:
+                rows = [json.loads(line) for line in f if line.strip()]
+        for row in rows:
+            row['file'] = os.path.join(os.path.dirname(source), row['file'])
+    jobs = []
+    for row in rows:
+        job = OrderedDict([('file', row['file'])])
+        for name in ('bpm', 'divisions', 'voices'):
+            value = row.get(name)
+            job[name] = int(value) if value not in (None, '') else defaults[name]
+        jobs.append(job)
+    return jobs
+
+# pool entry point: analyses one file, resynthesizing it into output_dir if one is given.
+# Never raises, a failure is reported in the error field of the result
+def analyse_job(job, window=None, zero_pad=1, output_dir=None):
+    result = OrderedDict(job)
+    timer = PhaseTimer()
+    try:
+        if result['bpm'] is None or result['divisions'] is None:
+            raise ValueError('no bpm or divisions given')
+        letter_notes, (n_frames, framerate, byte_depth, n_channels) = analyse_file(job['file'], job['bpm'], job['divisions'], job['voices'], window, zero_pad, timer, analysis_cache)
+        if output_dir is not None:
+            result['output_file'] = os.path.join(output_dir, os.path.basename(job['file']))
+            export_notes(letter_notes, result['output_file'], n_frames, framerate, byte_depth, n_channels, job['bpm'], job['divisions'], timer)
+        result['frames'] = n_frames
+        result['notes'] = letter_notes
+    except Exception:
+        result['error'] = traceback.format_exc().strip().splitlines()[-1]
+    result['seconds'] = sum(timer.totals.values())
+    return result
+
+# Writes results as JSON lines, or as CSV rows with the notes of a division joined by + and
+# the divisions by spaces
+class ResultWriter(object):
+    csv_fields = ['file', 'bpm', 'divisions', 'voices', 'frames', 'seconds', 'output_file', 'error', 'notes']
+
+    def __init__(self, f, result_format):
+        self.f = f
+        self.csv = None
+        if result_format == 'csv':
+            self.csv = csv.DictWriter(f, self.csv_fields, extrasaction='ignore')
+            self.csv.writeheader()
+
+    def write(self, result):
+        if self.csv is None:
+            self.f.write(json.dumps(result) + '\n')
+        else:
+            row = dict(result)
+            row['notes'] = ' '.join('+'.join(notes) for notes in result.get('notes', []))
+            self.csv.writerow(row)
+        self.f.flush()
+
+def ParseArguments():
+    parser = argparse.ArgumentParser(description='Find the notes of many wave files at once with the fft method')
+    parser.add_argument('source', help='A directory of wave files, or a manifest: a CSV (with a header) or JSON lines file with file and optionally bpm, divisions and voices of every wave file')
+    parser.add_argument('-b', '--bpm', type=int, help='Beats per minute of files the manifest gives none for')
+    parser.add_argument('-d', '--divisions', type=int, help='Divisions of a beat of files the manifest gives none for')
+    parser.add_argument('-v', '--voices', type=int, help='Voices to pull from files the manifest gives none for (default 5)')
+    parser.add_argument('-w', '--window', choices=sorted(window_functions.keys()), help='Window function applied to each division before the fft (default none)')
+    parser.add_argument('-z', '--zero-pad', type=int, help='Zero-pad each division to this many times its length before the fft (default 1)')
+    parser.add_argument('-o', '--output-file', help='File the results are written to (default standard output)')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv'], help='Format of the results (default csv if the output file ends in .csv, else jsonl)')
+    parser.add_argument('-r', '--resynthesize', help='Also write the audio of the notes of every file to a wave file of the same name in this directory')
+    parser.add_argument('-c', '--analysis-cache', help='Directory of a cache of decoded wave files and their spectra shared by the processes, so a file analysed before is not decoded or transformed again')
+    parser.add_argument('--analysis-cache-size', type=float, help='Disk budget of the analysis cache in MB (default 1024)')
+    parser.add_argument('-p', '--max-processes', type=int, help='Max number of processes at once (default the number of cpus)')
+    parser.add_argument('--max-in-flight', type=int, help='Max number of files being analysed or waiting to be written at once (default twice the processes)')
+    parser.add_argument('--max-in-flight-mb', type=float, help='Max total size in MB of the files in flight, a larger file runs on its own (default 512)')
+    argNamespace = parser.parse_args()
+    args = vars(argNamespace)
+    if args['voices'] is None:
+        args['voices'] = 5
+    if args['zero_pad'] is None:
+        args['zero_pad'] = 1
+    if args['format'] is None:
+        args['format'] = 'csv' if (args['output_file'] or '').lower().endswith('.csv') else 'jsonl'
+    if args['max_processes'] is None:
+        args['max_processes'] = cpu_count()
+    if args['max_in_flight'] is None:
+        args['max_in_flight'] = 2 * args['max_processes']
+    if args['max_in_flight_mb'] is None:
+        args['max_in_flight_mb'] = 512
+    if args['analysis_cache_size'] is None:
+        args['analysis_cache_size'] = 1024
+    return args
+
+def RunBatch():
+    args = ParseArguments()
+    jobs = read_jobs(args['source'], args)
+    if args['resynthesize'] is not None and not os.path.isdir(args['resynthesize']):
+        os.makedirs(args['resynthesize'])
+    out = open(args['output_file'], 'w') if args['output_file'] is not None else sys.stdout
+    writer = ResultWriter(out, args['format'])
+    budget_bytes = args['max_in_flight_mb'] * 1024 * 1024
+    n_written = 0
+    n_failed = 0
+
+    pool = Pool(args['max_processes'], init_worker, (args['analysis_cache'], int(args['analysis_cache_size'] * 1024 * 1024)))
+    try:
+        # submit files in order while the in-flight limits allow, and write the oldest result
+        # whenever they do not, so results come out in the order of the jobs
+        in_flight = deque()
+        in_flight_bytes = 0
+        for job in jobs + [None]:
+            job_bytes = os.path.getsize(job['file']) if job is not None and os.path.isfile(job['file']) else 0
+            while in_flight and (job is None or len(in_flight) >= args['max_in_flight'] or in_flight_bytes + job_bytes > budget_bytes):
+                pending, pending_job, pending_bytes = in_flight.popleft()
+                try:
+                    result = pending.get()
+                except Exception as e:
+                    # the worker could not send the result back
+                    result = OrderedDict(pending_job)
+                    result['error'] = '%s: %s' % (type(e).__name__, e)
+                in_flight_bytes -= pending_bytes
+                n_written += 1
+                n_failed += 'error' in result
+                writer.write(result)
+            if job is not None:
+                in_flight.append((pool.apply_async(analyse_job, (job, args['window'], args['zero_pad'], args['resynthesize'])), job, job_bytes))
+                in_flight_bytes += job_bytes
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt! Exiting!', file=sys.stderr)
+        pool.terminate()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print('%d of %d files done, %d failed' % (n_written, len(jobs), n_failed), file=sys.stderr)
+
+if __name__ == "__main__":
+    RunBatch()
@@ -0,0 +1,226 @@
+# Benchmarks of the fft and genetic note recognition on synthetic wave files
+# The notes of every file are known, so the accuracy of both is measured along with their speed
+# and memory, and compared to a stored baseline
+
+from __future__ import division, print_function
+import sys
+import os
+import json
+import shlex
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from collections import OrderedDict
+from fft import frequencies, generate_audio_blocks, write_wave
+
+# The synthetic files: mono and stereo, 8 and 16 bit, several sample rates, lengths, tempos
+# and divisions, with 1 to 5 voices. Every length is a whole number of divisions
+cases = [{'name': 'mono8-8k-1voice',     'n_channels': 1, 'byte_depth': 1, 'sample_rate': 8000,  'seconds': 4,  'bpm': 120, 'divisions': 4, 'voices': 1},
+         {'name': 'mono16-22k-2voices',  'n_channels': 1, 'byte_depth': 2, 'sample_rate': 22050, 'seconds': 6,  'bpm': 90,  'divisions': 2, 'voices': 2},
+         {'name': 'stereo16-44k-3voices', 'n_channels': 2, 'byte_depth': 2, 'sample_rate': 44100, 'seconds': 4,  'bpm': 120, 'divisions': 4, 'voices': 3},
+         {'name': 'stereo8-22k-4voices', 'n_channels': 2, 'byte_depth': 1, 'sample_rate': 22050, 'seconds': 8,  'bpm': 60,  'divisions': 4, 'voices': 4},
+         {'name': 'mono16-44k-5voices',  'n_channels': 1, 'byte_depth': 2, 'sample_rate': 44100, 'seconds': 12, 'bpm': 140, 'divisions': 4, 'voices': 5}]
+
+# notes the synthetic files are made of: octaves 4 to 6, far enough apart to tell in a division
+# and in the range of the genetic algorithm
+note_pool = sorted([letter for letter in frequencies if letter[-1] in '456'], key=lambda letter: frequencies[letter])
+
+# how far each metric may get worse than the baseline before it counts as a regression:
+# a fraction of the baseline for speed and memory, an absolute drop for accuracy
+default_thresholds = {'speed': 0.2, 'memory': 0.2, 'accuracy': 0.05}
+
+# Random notes, <voices> different ones per division, for every division of a case
+def case_notes(case, rng):
+    n_divisions = case['seconds'] * case['bpm'] * case['divisions'] // 60
+    return [[note_pool[i] for i in rng.choice(len(note_pool), case['voices'], replace=False)] for d in range(n_divisions)]
+
+# Writes the wave file of a case playing letter_notes
+def write_case(case, letter_notes, file_name):
+    n_samples = case['seconds'] * case['sample_rate']
+    blocks = generate_audio_blocks(letter_notes, n_samples, case['sample_rate'], case['byte_depth'], case['n_channels'], case['bpm'], case['divisions'])
+    write_wave(file_name, blocks, n_samples, case['n_channels'], case['byte_depth'], case['sample_rate'])
+
+# Share of the notes of every division that were found, averaged over the divisions
+def note_accuracy(found_notes, letter_notes):
+    return float(np.mean([len(set(found) & set(notes)) / len(notes) for found, notes in zip(found_notes, letter_notes)]))
+
+# Runs a command with its output thrown away, raises RuntimeError if it fails
+def run_command(command):
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stdout=devnull, stderr=subprocess.PIPE)
+        stderr = process.communicate()[1]
+    if process.returncode != 0:
+        raise RuntimeError('%s failed:\n%s' % (' '.join(command), stderr.decode('utf-8', 'replace')))
+
+def read_metrics(metrics_file):
+    with open(metrics_file) as f:
+        return [json.loads(line) for line in f]
+
+# Runs fft.py on a case. Returns its results
+def benchmark_fft(case, letter_notes, wav_file, work_dir, python):
+    metrics_file = os.path.join(work_dir, case['name'] + '.fft.jsonl')
+    command = [python, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fft.py'), wav_file, str(case['bpm']), str(case['divisions']),
+               '-v', str(case['voices']), '-o', os.path.join(work_dir, case['name'] + '.fft.wav'), '--metrics-file', metrics_file]
+    run_command(command)
+    analysis = read_metrics(metrics_file)[-1]
+    analysis_seconds = sum(analysis['seconds'].values())
+    return OrderedDict([('samples_per_second', case['seconds'] * case['sample_rate'] * case['n_channels'] / analysis_seconds),
+                        ('peak_mb', analysis['peak_mb']),
+                        ('accuracy', note_accuracy(analysis['notes'], letter_notes))])
+
+# Runs generation.py on a case. Returns its results
+def benchmark_ga(case, letter_notes, wav_file, work_dir, python, ga_args, seed):
+    metrics_file = os.path.join(work_dir, case['name'] + '.ga.jsonl')
+    command = [python, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generation.py'), wav_file, str(case['bpm']), str(case['divisions']),
+               '-s', str(seed), '-o', os.path.join(work_dir, case['name'] + '.ga.wav'), '--metrics-file', metrics_file] + ga_args
+    run_command(command)
+    records = read_metrics(metrics_file)
+    run = records[-1]
+    generations = [record for record in records if record['event'] == 'generation' and record['generation'] > 0]
+    scoring_seconds = sum(record['seconds'] for record in generations)
+    scored_samples = sum(record['samples_per_second'] * record['seconds'] for record in generations if record['samples_per_second'] is not None)
+    # the genetic algorithm finds one note per division, any of the notes playing counts
+    return OrderedDict([('samples_per_second', scored_samples / scoring_seconds if scoring_seconds > 0 else None),
+                        ('generations_per_second', run['generations'] / run['seconds'] if run['seconds'] > 0 else None),
+                        ('peak_mb', run['peak_mb']),
+                        ('worker_peak_mb', run['worker_peak_mb']),
+                        ('accuracy', float(np.mean([note in notes for note, notes in zip(run['notes'], letter_notes)]))),
+                        ('best_fitness', run['best_fitness'])])
+
+# Results of several runs of a pipeline on a case: the best throughput and the lowest peak
+# memory of the runs, as a single run times only milliseconds and varies with the load of the
+# machine. The other metrics are the same in every run
+def best_of(runs):
+    result = OrderedDict()
+    for name, value in runs[0].items():
+        values = [run[name] for run in runs if run[name] is not None]
+        if name in ('samples_per_second', 'generations_per_second') and values:
+            value = max(values)
+        elif name in ('peak_mb', 'worker_peak_mb') and values:
+            value = min(values)
+        result[name] = value
+    return result
+
+# Compares results to a baseline with the same layout. Returns a message for every regression
+def regressions(results, baseline, thresholds):
+    messages = []
+    for case_name, pipelines in sorted(results.items()):
+        for pipeline, metrics in sorted(pipelines.items()):
+            if 'error' in metrics:
+                messages.append('%s %s: %s' % (case_name, pipeline, metrics['error'].splitlines()[0]))
+                continue
+            known = baseline.get(case_name, {}).get(pipeline, {})
+            for name, value in metrics.items():
+                old = known.get(name)
+                if value is None or old is None:
+                    continue
+                if name in ('samples_per_second', 'generations_per_second') and value < old * (1 - thresholds['speed']):
+                    messages.append('%s %s: %s fell from %.4g to %.4g' % (case_name, pipeline, name, old, value))
+                elif name in ('peak_mb', 'worker_peak_mb') and value > old * (1 + thresholds['memory']):
+                    messages.append('%s %s: %s rose from %.1f to %.1f' % (case_name, pipeline, name, old, value))
+                elif name == 'accuracy' and value < old - thresholds['accuracy']:
+                    messages.append('%s %s: %s fell from %.3f to %.3f' % (case_name, pipeline, name, old, value))
+    return messages
+
+def ParseArguments():
+    parser = argparse.ArgumentParser(description='Benchmark the fft and genetic note recognition on synthetic wave files with known notes')
+    parser.add_argument('--cases', help='Comma separated names of the cases to run (default all: %s)' % ', '.join(case['name'] for case in cases))
+    parser.add_argument('--pipelines', help='Comma separated pipelines to run, fft and/or ga (default both)')
+    parser.add_argument('--python', help='Interpreter that runs fft.py (default the one running this)')
+    parser.add_argument('--python2', help='Interpreter that runs generation.py (default python2)')
+    parser.add_argument('--ga-args', help='Extra arguments of generation.py (default "-i 30 -g 10 -p 2")')
+    parser.add_argument('-r', '--repeats', type=int, help='Runs of each pipeline on each case, of which the best throughput and lowest memory count (default 10)')
+    parser.add_argument('-s', '--seed', type=int, help='Seed of the notes of the synthetic files and of the genetic algorithm (default 1)')
+    parser.add_argument('-o', '--output-file', help='Write the results as JSON to this file')
+    parser.add_argument('-b', '--baseline', help='JSON results of an earlier run to compare to. Exits with status 1 on a regression')
+    parser.add_argument('--speed-threshold', type=float, help='Fraction the throughput may fall below the baseline (default 0.2)')
+    parser.add_argument('--memory-threshold', type=float, help='Fraction the peak memory may rise above the baseline (default 0.2)')
+    parser.add_argument('--accuracy-threshold', type=float, help='Amount the note accuracy may fall below the baseline (default 0.05)')
+    parser.add_argument('--keep-files', help='Keep the synthetic wave files and the outputs in this directory')
+    argNamespace = parser.parse_args()
+    args = vars(argNamespace)
+    args['cases'] = args['cases'].split(',') if args['cases'] is not None else [case['name'] for case in cases]
+    args['pipelines'] = args['pipelines'].split(',') if args['pipelines'] is not None else ['fft', 'ga']
+    if args['python'] is None:
+        args['python'] = sys.executable
+    if args['python2'] is None:
+        args['python2'] = 'python2'
+    args['ga_args'] = shlex.split(args['ga_args'] if args['ga_args'] is not None else '-i 30 -g 10 -p 2')
+    if args['repeats'] is None:
+        args['repeats'] = 10
+    if args['seed'] is None:
+        args['seed'] = 1
+    for name in default_thresholds:
+        if args[name + '_threshold'] is None:
+            args[name + '_threshold'] = default_thresholds[name]
+    return args
+
+def RunBenchmarks():
+    args = ParseArguments()
+    unknown = set(args['cases']) - set(case['name'] for case in cases)
+    if unknown:
+        sys.exit('Unknown cases: %s' % ', '.join(sorted(unknown)))
+    work_dir = args['keep_files'] or tempfile.mkdtemp()
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    rng = np.random.RandomState(args['seed'])
+    selected = []
+    runs = OrderedDict()
+    failures = {}
+    try:
+        for case in cases:
+            # the notes of every case are drawn even when it is skipped, so each case always
+            # gets the same notes
+            letter_notes = case_notes(case, rng)
+            if case['name'] not in args['cases']:
+                continue
+            wav_file = os.path.join(work_dir, case['name'] + '.wav')
+            write_case(case, letter_notes, wav_file)
+            selected.append((case, letter_notes, wav_file))
+            for pipeline in args['pipelines']:
+                runs[case['name'], pipeline] = []
+        # every round runs each pipeline on each case once, so the runs of a case are spread
+        # over the whole benchmark rather than all falling in a moment the machine was busy
+        for repeat in range(args['repeats']):
+            print('Round %d of %d...' % (repeat + 1, args['repeats']))
+            for case, letter_notes, wav_file in selected:
+                for pipeline in args['pipelines']:
+                    if (case['name'], pipeline) in failures:
+                        continue
+                    try:
+                        if pipeline == 'fft':
+                            runs[case['name'], pipeline].append(benchmark_fft(case, letter_notes, wav_file, work_dir, args['python']))
+                        else:
+                            runs[case['name'], pipeline].append(benchmark_ga(case, letter_notes, wav_file, work_dir, args['python2'], args['ga_args'], args['seed']))
+                    except (RuntimeError, OSError) as e:
+                        failures[case['name'], pipeline] = str(e)
+    finally:
+        if args['keep_files'] is None:
+            shutil.rmtree(work_dir)
+
+    results = OrderedDict()
+    for (case_name, pipeline), case_runs in runs.items():
+        if (case_name, pipeline) in failures:
+            result = OrderedDict([('error', failures[case_name, pipeline])])
+        else:
+            result = best_of(case_runs)
+        results.setdefault(case_name, OrderedDict())[pipeline] = result
+        print('%s on %s: %s' % (pipeline, case_name, ', '.join('%s: %s' % (name, ('%.4g' % value) if isinstance(value, float) else value) for name, value in result.items())))
+    if args['output_file'] is not None:
+        with open(args['output_file'], 'w') as f:
+            json.dump(results, f, indent=2)
+    if args['baseline'] is not None:
+        with open(args['baseline']) as f:
+            baseline = json.load(f)
+        thresholds = dict((name, args[name + '_threshold']) for name in default_thresholds)
+        messages = regressions(results, baseline, thresholds)
+        for message in messages:
+            print('Regression: %s' % message)
+        if messages:
+            sys.exit(1)
+        print('No regressions against %s' % args['baseline'])
+
+if __name__ == "__main__":
+    RunBenchmarks()
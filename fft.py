@@ -1,14 +1,17 @@
 # FFT method for dentifying music notes in a wave file
 # Tom Conroy, 6/16/2019
 
+from __future__ import division, print_function
 import wave
 import sys
 import binascii
 import math
-import struct
 import argparse
+import json
 import numpy as np
 from collections import OrderedDict
+from metrics import PhaseTimer, MetricsWriter, peak_memory_mb, start_profile, stop_profile
+from analysis_cache import AnalysisCache
 # Note and their frequencies (A440 tuning)
 frequencies = OrderedDict({ 'C1':   32.7,
                 'C#1':  34.65,
@@ -95,51 +98,269 @@ frequencies = OrderedDict({ 'C1':   32.7,
                 'A#7':  3729.31,
                 'B7':   3951.07})
 
+# decodes raw little-endian frame data into a (channels x frames) float32 array in [-1, 1]
+def decode_frames(frame_data, byte_depth, n_channels):
+    if byte_depth == 2:
+        samples = np.frombuffer(frame_data, dtype='<i2').astype(np.float32) / 32767
+    else:
+        samples = (np.frombuffer(frame_data, dtype=np.uint8).astype(np.float32) - 128) / 128
+    return samples.reshape(-1, n_channels).T
+
+# reads an open wave file in blocks of up to block_frames frames, yielding each block decoded
+def read_blocks(audio_file, block_frames=65536):
+    byte_depth = audio_file.getsampwidth()
+    n_channels = audio_file.getnchannels()
+    while True:
+        frame_data = audio_file.readframes(block_frames)
+        if len(frame_data) == 0:
+            break
+        yield decode_frames(frame_data, byte_depth, n_channels)
+
+# reads a whole wave file into a (channels x frames) float32 array
+def load_wav(audio_file, block_frames=65536):
+    samples = np.empty((audio_file.getnchannels(), audio_file.getnframes()), dtype=np.float32)
+    position = 0
+    for block in read_blocks(audio_file, block_frames):
+        samples[:, position:position + block.shape[1]] = block
+        position += block.shape[1]
+    return samples[:, :position]
+
+# Decoded (channels x frames) samples of a wave file, from an AnalysisCache when it has them
+# (memory mapped, so nothing is decoded). Works without a cache
+def cached_samples(cache, audio_file_name):
+    key = ('samples', cache.content_hash(audio_file_name)) if cache is not None else None
+    samples = cache.get(key) if cache is not None else None
+    if samples is None:
+        audio_file = wave.open(audio_file_name, 'rb')
+        samples = load_wav(audio_file)
+        audio_file.close()
+        if cache is not None:
+            cache.put(key, samples)
+    return samples
+
+# division_spectra of the windows of a wave file, from an AnalysisCache when it has them.
+# The windows have to be the consecutive divisions of the first channel from the start of the
+# file, as they are only told apart by their number and length. Works without a cache
+def cached_spectra(cache, audio_file_name, windows, window=None, n_fft=None):
+    key = ('spectra', cache.content_hash(audio_file_name), windows.shape[0], windows.shape[1], window, n_fft or windows.shape[1]) if cache is not None else None
+    spectra = cache.get(key) if cache is not None else None
+    if spectra is None:
+        spectra = division_spectra(windows, window, n_fft)
+        if cache is not None:
+            cache.put(key, spectra)
+    return spectra
+
+# stacks the consecutive frames_per_division long windows of a channel into a
+# (windows x frames_per_division) strided view, without copying
+def division_windows(samples, frames_per_division, hop=None):
+    if hop is None:
+        hop = frames_per_division
+    n_windows = max(0, (len(samples) - frames_per_division) // hop + 1)
+    stride = samples.strides[0]
+    return np.lib.stride_tricks.as_strided(samples, shape=(n_windows, frames_per_division), strides=(hop * stride, stride), writeable=False)
+
+# magnitude spectra of every row of a windows matrix in a single rfft,
+# optionally tapered by a window function and zero-padded to n_fft samples
+def division_spectra(windows, window=None, n_fft=None):
+    if window is not None:
+        windows = windows * window_functions[window](windows.shape[1])
+    return np.abs(np.fft.rfft(windows, n=n_fft, axis=1))
+
+window_functions = {'hann': np.hanning, 'hamming': np.hamming, 'blackman': np.blackman}
+
+# finds the n highest amplitude frequencies of the first n_bins bins of every spectrum,
+# lowest amplitude first. bin_scale is frames_per_division / n_fft for zero-padded spectra.
+# Returns (spectra x n) matrices of frequencies and magnitudes
+def find_peaks_batch(spectra, n_bins, division_time, n=5, bin_scale=1.0):
+    spectra = spectra[:, :n_bins]
+    n = min(n, n_bins)
+    peak_bins = np.argpartition(spectra, n_bins - n, axis=1)[:, n_bins - n:]
+    magnitudes = np.take_along_axis(spectra, peak_bins, axis=1)
+    order = np.argsort(magnitudes, axis=1, kind='mergesort')
+    peak_bins = np.take_along_axis(peak_bins, order, axis=1)
+    magnitudes = np.take_along_axis(magnitudes, order, axis=1)
+    return peak_bins * bin_scale / division_time, magnitudes
+
+# finds n highest amplitude frequencies and their magnitudes
+def find_peaks(fft_result, division_time, n=5):
+    notes, magnitudes = find_peaks_batch(fft_result[np.newaxis, :], len(fft_result) // 2, division_time, n)
+    return notes[0].tolist(), magnitudes[0].tolist()
+
 # finds n highest amplitude frequencies
 def find_maxima(fft_result, division_time, n=5):
-    sorted_fft = np.sort(fft_result[:len(fft_result) // 2])
-    notes = []
-    for note in sorted_fft[-n:]:
-        freq = np.where(fft_result ==  note)[0].tolist()[0] / division_time
-        notes.append(freq)
-    return notes
-
-# convert notes to audio data samples
-def generate_audio(letter_notes, n_samples, sample_rate, byte_depth, n_channels, bpm, division):
+    return find_peaks(fft_result, division_time, n)[0]
+
+# frequencies and magnitudes of the n highest amplitude peaks of every division window
+def analyse_windows(windows, division_time, n=5, window=None, zero_pad=1):
+    frames_per_division = windows.shape[1]
+    n_fft = frames_per_division * zero_pad
+    spectra = division_spectra(windows, window, n_fft)
+    return find_peaks_batch(spectra, n_fft // 2, division_time, n, frames_per_division / n_fft)
+
+# Maps frequencies to the nearest note of a note table. The notes are sorted by
+# frequency once, so whole arrays of frequencies are matched with one np.searchsorted
+class NoteIndex(object):
+    def __init__(self, note_frequencies):
+        notes = sorted(note_frequencies.items(), key=lambda note: note[1])
+        self.letters = [letter for letter, freq in notes]
+        self.frequencies = np.array([freq for letter, freq in notes])
+        # a frequency exactly between two notes goes to the higher one
+        self.boundaries = (self.frequencies[:-1] + self.frequencies[1:]) / 2
+
+    # index (into letters and frequencies) of the nearest note of every frequency
+    def nearest(self, freqs):
+        return np.searchsorted(self.boundaries, freqs, side='right')
+
+    # letters of the nearest note of every frequency in a flat sequence
+    def letters_of(self, freqs):
+        return [self.letters[i] for i in np.ravel(self.nearest(freqs))]
+
+note_index = NoteIndex(frequencies)
+
+# name of the note closest to a frequency
+def nearest_note(freq):
+    return note_index.letters[note_index.nearest(freq)]
+
+# Reads a wave file incrementally and yields a note event for every division:
+#   division: index of the division
+#   time: start of the division in seconds
+#   notes: letters of the n highest amplitude notes
+#   magnitudes: fft magnitude of each of those notes
+# Only block_divisions divisions of the left (or only) channel are held in memory at once
+def stream_notes(audio_file_name, bpm, divisions, voices=5, block_divisions=16, window=None, zero_pad=1):
+    audio_file = wave.open(audio_file_name, 'rb')
+    try:
+        framerate = audio_file.getframerate()
+        division_time = 1 / (bpm * divisions / 60)
+        frames_per_division = int(framerate * division_time)
+        pending = np.zeros(0, dtype=np.float32)
+        division = 0
+        for block in read_blocks(audio_file, frames_per_division * block_divisions):
+            pending = np.concatenate((pending, block[0]))
+            windows = division_windows(pending, frames_per_division)
+            notes, magnitudes = analyse_windows(windows, division_time, voices, window, zero_pad)
+            note_indices = note_index.nearest(notes)
+            for current_notes, current_magnitudes in zip(note_indices.tolist(), magnitudes.tolist()):
+                yield {'division': division,
+                       'time': division * frames_per_division / framerate,
+                       'notes': [note_index.letters[note] for note in current_notes],
+                       'magnitudes': current_magnitudes}
+                division += 1
+            pending = pending[len(windows)*frames_per_division:]
+    finally:
+        audio_file.close()
+
+# Renders the chords of a run of divisions as one (divisions * samples_per_division) array of
+# floats in [-1, 1]. voice_freqs is a (divisions x voices) matrix with 0 for silent voices.
+# Every voice keeps a phase accumulator, starting from phase, so a voice that changes note
+# carries on from the phase it reached instead of jumping. Returns the samples and the
+# phase of each voice at the end
+def synthesize_divisions(voice_freqs, samples_per_division, sample_rate, phase):
+    increments = 2 * math.pi * voice_freqs / sample_rate
+    division_phases = np.cumsum(increments * samples_per_division, axis=0)
+    start_phases = phase + division_phases - (increments * samples_per_division)
+    sample_phases = start_phases[:, :, np.newaxis] + increments[:, :, np.newaxis] * np.arange(samples_per_division)
+    # missing voices (0) are silent, their phase stands still but is not heard
+    sounding = (voice_freqs != 0)[:, :, np.newaxis]
+    n_voices = np.maximum(1, np.count_nonzero(voice_freqs, axis=1))[:, np.newaxis]
+    mix = (np.sin(sample_phases) * sounding).sum(axis=1) / n_voices
+    end_phase = np.mod(phase + division_phases[-1], 2 * math.pi)
+    return mix.ravel(), end_phase
+
+# (divisions x voices) matrix of note frequencies, each division's notes sorted so voices
+# follow the same pitch from one division to the next. Missing voices are 0
+def voice_frequencies(letter_notes):
+    n_voices = max([len(current_letter_notes) for current_letter_notes in letter_notes] + [1])
+    voice_freqs = np.zeros((len(letter_notes), n_voices))
+    for i, current_letter_notes in enumerate(letter_notes):
+        voice_freqs[i, :len(current_letter_notes)] = sorted(frequencies[letter] for letter in current_letter_notes)
+    return voice_freqs
+
+# Converts notes to audio data, as blocks of bytes of whole divisions, at most block_frames
+# frames long unless a single division is longer, so the audio never has to be in memory at once
+def generate_audio_blocks(letter_notes, n_samples, sample_rate, byte_depth, n_channels, bpm, division, block_frames=65536):
     # time in seconds of each division
     min_time = 60.0 / (bpm * division)
     total_time = float(n_samples) / sample_rate
     number_of_smallest_divisions = total_time / min_time
-    samples_per_division = n_samples / number_of_smallest_divisions
-    
-    frame_data = []
-    s_time = 0
-    for current_letter_notes in letter_notes:
-        for s in range(int(samples_per_division)):
-            s_time += min_time / samples_per_division
-            sample_val = 0
-            amplitude = 0
-            for letter in current_letter_notes:
-                note = frequencies[letter]
-                amplitude += 1
-                if byte_depth == 1:
-                    sample_val += int(127 * math.sin(2*math.pi*note*s_time)) + 128
-                else:
-                    sample_val += int(32767 * math.sin(2*math.pi*note*s_time))
-            sample_val = sample_val // amplitude
-            if byte_depth == 1:
-                val = bytes([sample_val])
-            else:
-                val = struct.pack('<h', sample_val)
-            if n_channels == 1:
-                frame_data.append(val)
-            else:
-                frame_data.append(val)
-                frame_data.append(val)
-    audio_data = b''.join(b for b in frame_data)
-    missing = (n_samples*byte_depth*n_channels) - len(audio_data)
-    audio_data += missing*bytes([128])
-    return audio_data
+    samples_per_division = int(n_samples / number_of_smallest_divisions)
+
+    voice_freqs = voice_frequencies(letter_notes)
+    phase = np.zeros(voice_freqs.shape[1])
+    block_divisions = max(1, block_frames // max(1, samples_per_division))
+    written = 0
+    for start in range(0, len(voice_freqs), block_divisions):
+        mix, phase = synthesize_divisions(voice_freqs[start:start + block_divisions], samples_per_division, sample_rate, phase)
+        # keep rounding from wrapping past the largest sample
+        mix = np.clip(mix[:n_samples - written], -1, 1)
+        if byte_depth == 1:
+            samples = (np.round(127 * mix) + 128).astype(np.uint8)
+        else:
+            samples = np.round(32767 * mix).astype('<i2')
+        written += len(samples)
+        yield np.repeat(samples, n_channels).tobytes()
+    # anything after the last division is silence
+    silence = b'\x80' if byte_depth == 1 else b'\x00\x00'
+    while written < n_samples:
+        n_silent = min(block_frames, n_samples - written)
+        written += n_silent
+        yield silence * (n_silent * n_channels)
+
+# convert notes to audio data samples, all at once
+def generate_audio(letter_notes, n_samples, sample_rate, byte_depth, n_channels, bpm, division, block_frames=65536):
+    return b''.join(generate_audio_blocks(letter_notes, n_samples, sample_rate, byte_depth, n_channels, bpm, division, block_frames))
+
+# Writes audio given as blocks of bytes (e.g. by generate_audio_blocks) to a wave file of
+# n_frames frames, one block at a time
+def write_wave(output_file, blocks, n_frames, n_channels, byte_depth, framerate):
+    wave_file = wave.open(output_file, 'wb')
+    try:
+        wave_file.setnchannels(n_channels)
+        wave_file.setsampwidth(byte_depth)
+        wave_file.setframerate(framerate)
+        # the header is right from the start, so it is not patched after every block
+        wave_file.setnframes(n_frames)
+        for block in blocks:
+            wave_file.writeframes(block)
+    finally:
+        wave_file.close()
+
+# Finds the <voices> strongest notes in every division of a wave file, timing each stage with
+# timer. Notes are picked from the left (or only) channel. With an AnalysisCache, the decoded
+# samples and the spectra come from (or go to) the cache.
+# Returns the letters of the notes of every division and the (n_frames, framerate, byte_depth,
+# n_channels) of the file
+def analyse_file(audio_file_name, bpm, divisions, voices=5, window=None, zero_pad=1, timer=None, cache=None):
+    timer = timer or PhaseTimer()
+    audio_file = wave.open(audio_file_name, 'rb')
+    byte_depth = audio_file.getsampwidth()
+    n_channels = audio_file.getnchannels()
+    framerate = audio_file.getframerate()
+    audio_file.close()
+    with timer.phase('load'):
+        audio_samples = cached_samples(cache, audio_file_name)[0]
+
+    division_time = 1 / (bpm * divisions / 60)
+    frames_per_division = int(framerate * division_time)
+    windows = division_windows(audio_samples, frames_per_division)
+    # analyse_windows, one stage at a time
+    n_fft = frames_per_division * zero_pad
+    with timer.phase('fft'):
+        spectra = cached_spectra(cache, audio_file_name, windows, window, n_fft)
+    with timer.phase('peaks'):
+        peak_freqs = find_peaks_batch(spectra, n_fft // 2, division_time, voices, frames_per_division / n_fft)[0]
+    with timer.phase('notes'):
+        notes = note_index.nearest(peak_freqs)
+        letter_notes = [[note_index.letters[note] for note in current_notes] for current_notes in notes.tolist()]
+    return letter_notes, (len(audio_samples), framerate, byte_depth, n_channels)
+
+# Synthesizes notes (the letters of every division) and writes them to a wave file,
+# block_frames frames at a time
+def export_notes(letter_notes, output_file, n_frames, framerate, byte_depth, n_channels, bpm, divisions, timer=None, block_frames=65536):
+    timer = timer or PhaseTimer()
+    blocks = generate_audio_blocks(letter_notes, n_samples=n_frames, sample_rate=framerate, byte_depth=byte_depth, n_channels=n_channels, bpm=bpm, division=divisions, block_frames=block_frames)
+    with timer.phase('write'):
+        write_wave(output_file, timer.timed_iter('synthesis', blocks), n_frames, n_channels, byte_depth, framerate)
 
 # Use argparse to create command line options
 def ParseArguments():
@@ -148,7 +369,15 @@ def ParseArguments():
     parser.add_argument('bpm', type=int, help='The number of beats per minute of the music')
     parser.add_argument('divisions', type=int, help='The largest number of divisions of a beat, e.g. if the music contains 16th notes, they (usually) divide the beat by 4')
     parser.add_argument('-v', '--voices', type=int, help='The number of voices to pull from the audio')
-    parser.add_argument('-o', '--output-file', help='File which to output generated audio')
+    parser.add_argument('-o', '--output-file', help='File which to output generated audio (default export.wav)')
+    parser.add_argument('-w', '--window', choices=sorted(window_functions.keys()), help='Window function applied to each division before the fft (default none)')
+    parser.add_argument('-z', '--zero-pad', type=int, default=1, help='Zero-pad each division to this many times its length before the fft (default 1)')
+    parser.add_argument('-b', '--block-frames', type=int, default=65536, help='Frames of audio synthesized and written at a time (default 65536)')
+    parser.add_argument('-s', '--stream', action='store_true', help='Read the file incrementally and print one JSON line of notes per division instead of generating audio')
+    parser.add_argument('-c', '--analysis-cache', help='Directory of a cache of decoded wave files and their spectra, so a file analysed before is not decoded or transformed again')
+    parser.add_argument('--analysis-cache-size', type=float, default=1024, help='Disk budget of the analysis cache in MB (default 1024)')
+    parser.add_argument('--metrics-file', help='Write the time spent in every stage of the analysis as a JSON line to this file')
+    parser.add_argument('--profile', help='Dump cProfile stats of the run to this file')
     argNamespace = parser.parse_args()
     args = vars(argNamespace)
     return args
@@ -162,88 +391,39 @@ def RunAnalysis():
     if 'voices' in args.keys():
         if args['voices'] is not None:
             voices = args['voices']
-    audio_file = wave.open(audio_file_name, 'rb')
-    n_frames = audio_file.getnframes()
-    byte_depth = audio_file.getsampwidth()
-    n_channels = audio_file.getnchannels()
+    if args['stream']:
+        for event in stream_notes(audio_file_name, bpm, divisions, voices, window=args['window'], zero_pad=args['zero_pad']):
+            print(json.dumps(event))
+            sys.stdout.flush()
+        return
+    timer = PhaseTimer()
+    profiler = start_profile(args['profile'])
 
     print('Running note recognition on file: %s' % audio_file_name)
+    cache = None
+    if args['analysis_cache'] is not None:
+        cache = AnalysisCache(args['analysis_cache'], int(args['analysis_cache_size'] * 1024 * 1024))
+    letter_notes, (n_frames, framerate, byte_depth, n_channels) = analyse_file(audio_file_name, bpm, divisions, voices, args['window'], args['zero_pad'], timer, cache)
     print('Audio file has %s frames' % n_frames)
     print('Number of channels: %d' % n_channels)
     print('Sample width (bytes): %d' % byte_depth)
-    if n_channels == 2:
-        left_audio_samples = []
-        right_audio_samples = []
-        for i in range(n_frames):
-            frame = audio_file.readframes(1)
-            if byte_depth == 2:
-                left_sample = int.from_bytes(frame[:2], byteorder="little", signed=True) / 32767
-                right_sample = int.from_bytes(frame[2:], byteorder="little", signed=True) / 32767
-                
-                left_audio_samples.append(left_sample)
-                right_audio_samples.append(right_sample)
-            else:
-                left_sample = ord(frame[0])
-                right_sample = ord(frame[1])
-                
-                left_audio_samples.append(left_sample)
-                right_audio_samples.append(right_sample)
-    else:
-        audio_samples = []
-        for i in range(n_frames):
-            frame = audio_file.readframes(1)
-            if byte_depth == 2:
-                sample = int.from_bytes(frame, byteorder="little", signed=True) / 32767
-                audio_samples.append(sample)
-            else:
-                sample = ord(frame[0])
-                audio_samples.append(sample)
-
-    framerate = audio_file.getframerate()
     print("Sample rate of audio: %d" % framerate)
-    audio_file.close()
-
-    frametime = 1 / framerate
-    division_time = 1 / (bpm * divisions / 60)
-    frames_per_division = int(framerate * division_time)
-    notes = []
-    for i in range(n_frames // frames_per_division):
-        fft_result = np.abs(np.fft.fft(left_audio_samples[i*frames_per_division:(i+1)*frames_per_division]))
-        current_notes = find_maxima(fft_result, division_time, voices)
-        notes.append(current_notes)
 
-    letter_notes = []
     print('Notes:', end=' ')
-    for current_notes in notes:
-        current_letter_notes = []
-        for note in current_notes:
-            diff = 10000
-            letter = 'C1'
-            for pitch in frequencies.keys():
-                if abs(frequencies[pitch] - note) > diff:
-                    break
-                else:
-                    letter = pitch
-                    diff = abs(frequencies[pitch] - note)
-            current_letter_notes.append(letter)
-        letter_notes.append(current_letter_notes)
+    for current_letter_notes in letter_notes:
         print(current_letter_notes, end=' ')
     print('')
 
     print("Generating audio file...")
-    final_audio = generate_audio(letter_notes, n_samples=n_frames, sample_rate=framerate, byte_depth=byte_depth, n_channels=n_channels, bpm=bpm, division=divisions)
-    
+    export_notes(letter_notes, args['output_file'] or 'export.wav', n_frames, framerate, byte_depth, n_channels, bpm, divisions, timer, args['block_frames'])
     print('Done!')
+    stop_profile(profiler, args['profile'])
     
-    of = 'export.wav'
-    if 'output_file' in args.keys():
-        of = args['output_file']
-    export_wave_file = wave.open(of, 'wb')
-    export_wave_file.setnchannels(n_channels)
-    export_wave_file.setsampwidth(byte_depth)
-    export_wave_file.setframerate(framerate)
-    export_wave_file.writeframesraw(final_audio)
-    export_wave_file.close()
+    seconds = sum(timer.totals.values())
+    metrics = MetricsWriter(args['metrics_file'])
+    metrics.write('analysis', file=audio_file_name, frames=n_frames, divisions=len(letter_notes), seconds=timer.totals, notes=letter_notes, peak_mb=peak_memory_mb(),
+                  samples_per_second=n_frames / seconds if seconds > 0 else None)
+    metrics.close()
 
 if __name__ == "__main__":
     RunAnalysis()
\ No newline at end of file
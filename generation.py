@@ -4,14 +4,20 @@
 import wave
 import sys
 import binascii
-import random
 import math
-import struct
 import argparse
 from multiprocessing import Pool
 from functools import partial
 import time, datetime
 import signal
+import os
+import tempfile
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from fft import NoteIndex, division_spectra, find_peaks_batch, cached_spectra, write_wave, window_functions
+from analysis_cache import AnalysisCache
+from metrics import PhaseTimer, MetricsWriter, summary, peak_memory_mb, start_profile, stop_profile
 
 # Note and their frequencies (A440 tuning)
 frequencies = { 'C1':   32.7,
@@ -86,115 +92,662 @@ frequencies = { 'C1':   32.7,
                 'A6':   1760.00,
                 'A#6':  1864.66,
                 'B6':   1975.53}
+note_index = NoteIndex(frequencies)
 
-# Ignore KeyboardInterrupt in pool
-def init_worker():
+# answer audio (one (answer divisions, decimation) pair per resolution level, full resolution
+# first), segment cache and fitness memo (used by islands) of this process, set up by init_worker
+shared_answer_levels = []
+segment_cache = None
+fitness_memo = None
+
+# Ignore KeyboardInterrupt in pool, map the shared answer audio of every level
+def init_worker(answer_levels=(), cache_bytes=0, phase_steps=0, cache_errors=False, memo_bytes=0):
+    global shared_answer_levels, segment_cache, fitness_memo
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shared_answer_levels = [(np.load(answer_file, mmap_mode='r'), decimation) for answer_file, decimation in answer_levels]
+    if cache_bytes > 0:
+        segment_cache = SegmentCache(cache_bytes, phase_steps, cache_errors)
+    if memo_bytes > 0:
+        fitness_memo = LRUCache(memo_bytes)
+
+# LRU cache bounded by a byte budget
+class LRUCache(object):
+    # rough size of the key and dictionary slot of an entry
+    entry_overhead = 100
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.lookup(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    # (value, size) entry of key, made the most recently used, or None. Not counted
+    def lookup(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def put(self, key, value, size):
+        size += self.entry_overhead
+        if size > self.max_bytes:
+            return
+        old_entry = self.entries.pop(key, None)
+        if old_entry is not None:
+            self.n_bytes -= old_entry[1]
+        self.entries[key] = (value, size)
+        self.n_bytes += size
+        while self.n_bytes > self.max_bytes:
+            self.n_bytes -= self.entries.popitem(last=False)[1][1]
+
+    # hits, misses, bytes used and number of entries
+    def stats(self):
+        return self.hits, self.misses, self.n_bytes, len(self.entries)
+
+# LRU cache of rendered gene segments, keyed by frequency and quantized phase, and
+# optionally of their error against each division of the answer audio
+class SegmentCache(LRUCache):
+    def __init__(self, max_bytes, phase_steps, cache_errors=False):
+        LRUCache.__init__(self, max_bytes)
+        self.phase_steps = phase_steps
+        self.cache_errors = cache_errors
+        self.error_hits = 0
+        self.error_misses = 0
+
+    # cached error of a segment against a division, counted apart from the segment lookups so
+    # the hit rate of each means one thing
+    def get_error(self, key):
+        entry = self.lookup(key)
+        if entry is None:
+            self.error_misses += 1
+            return None
+        self.error_hits += 1
+        return entry[0]
+
+    # segment hits and misses, error hits and misses, bytes used and number of entries
+    def stats(self):
+        return self.hits, self.misses, self.error_hits, self.error_misses, self.n_bytes, len(self.entries)
+
+# index of the nearest of <phase_steps> evenly spaced phases in [-pi, pi)
+def quantize_phase(phase, phase_steps):
+    return np.round((np.asarray(phase) + math.pi) / (2 * math.pi) * phase_steps).astype(np.int64) % phase_steps
+
+def phase_of_step(step, phase_steps):
+    return (2 * math.pi * step / phase_steps) - math.pi
+
+# snap every phase of a chromosome to the phases the segment cache renders
+def quantize_chromosome(chromosome, phase_steps):
+    return [(freq, phase_of_step(step, phase_steps)) for (freq, phase), step in zip(chromosome, quantize_phase([g[1] for g in chromosome], phase_steps))]
     
-# Compares samples of two lists of samples and produces a fitness score
+# view audio (a byte string, list of byte values or byte array) as an array of samples
+def as_samples(audio, byte_depth):
+    if isinstance(audio, str):
+        return np.frombuffer(audio, dtype=sample_dtype(byte_depth))
+    audio = np.asarray(audio)
+    if audio.dtype != sample_dtype(byte_depth):
+        audio = np.ascontiguousarray(audio, dtype=np.uint8).view(sample_dtype(byte_depth))
+    return audio
+
+# Compares samples of the test audio with the answer audio and produces a fitness score.
+# test_audio can be a single chromosome's audio or a (population x samples) matrix,
+# in which case one score per row is returned
 def fitness(test_audio, answer_audio, byte_depth):
-    if len(test_audio) != len(answer_audio):
+    test_audio = as_samples(test_audio, byte_depth)
+    answer_audio = as_samples(answer_audio, byte_depth)
+    if test_audio.shape[-1] != answer_audio.shape[-1]:
         print 'Error: test audio and answer audio not the same length'
         sys.exit()
-    fitness_score = 0
-    correct_sample = ''
-    test_sample = ''
-    for test_val,correct_val in zip(test_audio,answer_audio):
-        correct_sample += chr(correct_val)
-        test_sample += chr(test_val)
-        if len(correct_sample) == byte_depth:
-            if byte_depth == 2:
-                fitness_score += abs(struct.unpack('h', test_sample)[0] - struct.unpack('h', correct_sample)[0])
-            else:
-                fitness_score += abs(ord(test_sample) - ord(correct_sample))
-            correct_sample = ''
-            test_sample = ''
+    errors = np.abs(test_audio.astype(np.int32) - answer_audio.astype(np.int32))
+    fitness_score = errors.sum(axis=-1, dtype=np.int64)
+    if fitness_score.ndim == 0:
+        return int(fitness_score)
     return fitness_score
 
-# Creates chromosomes, genes being:
-#   frequencies
-#   phase
-def GenerateChromosome(n_samples, sample_rate, bpm, division):
-    min_time = 60.0 / (bpm * division)
-    total_time = float(n_samples) / sample_rate
-    number_of_smallest_divisions = total_time / min_time
-    chromosome = []
-    for i in range(int(number_of_smallest_divisions)):
-        freq = random.choice(frequencies.values())
-        phase = (2 * math.pi * random.random()) - math.pi
-        chromosome.append((freq,phase))
-    return chromosome
-
-# convert chromosomes to audio data samples
-def generate_random_audio(chromosome, n_samples, sample_rate, byte_depth, n_channels, bpm, division):
-    # time in seconds of each division
+# fitness is a sum of absolute sample errors, so it splits into one error per division
+# plus the error of the padding after the last full division.
+# Returns the answer audio as a (divisions x samples) matrix and the padding error
+def split_answer_audio(answer_audio, n_samples, sample_rate, byte_depth, n_channels, bpm, division):
+    min_time, number_of_smallest_divisions, samples_per_division = division_layout(n_samples, sample_rate, bpm, division)
+    answer_audio = as_samples(answer_audio, byte_depth)
+    division_length = int(samples_per_division) * n_channels
+    covered = int(number_of_smallest_divisions) * division_length
+    answer_divisions = answer_audio[:covered].reshape(int(number_of_smallest_divisions), division_length)
+    padding = np.full((len(answer_audio) - covered) * byte_depth, 128, dtype=np.uint8)
+    padding_error = fitness(padding, answer_audio[covered:], byte_depth)
+    return answer_divisions, padding_error
+
+# Low-pass filters the answer audio below the nyquist frequency of 1/<decimation> of the sample
+# rate (windowed-sinc FIR) and keeps every <decimation>th sample of each division.
+# Returns a (divisions x decimated samples) matrix, the coarse version of split_answer_audio
+def decimate_answer_audio(answer_audio, n_samples, sample_rate, byte_depth, n_channels, bpm, division, decimation):
+    min_time, number_of_smallest_divisions, samples_per_division = division_layout(n_samples, sample_rate, bpm, division)
+    answer_audio = as_samples(answer_audio, byte_depth).reshape(-1, n_channels)
+    taps = np.arange(8 * decimation + 1) - (4 * decimation)
+    anti_alias = np.sinc(taps / float(decimation)) * np.hamming(len(taps))
+    anti_alias /= anti_alias.sum()
+    filtered = np.empty(answer_audio.shape)
+    for channel in range(n_channels):
+        filtered[:, channel] = np.convolve(answer_audio[:, channel], anti_alias, mode='same')
+    info = np.iinfo(sample_dtype(byte_depth))
+    filtered = np.clip(np.round(filtered), info.min, info.max).astype(sample_dtype(byte_depth))
+    covered = int(number_of_smallest_divisions) * int(samples_per_division)
+    filtered = filtered[:covered].reshape(int(number_of_smallest_divisions), int(samples_per_division), n_channels)
+    return np.ascontiguousarray(filtered[:, ::decimation]).reshape(int(number_of_smallest_divisions), -1)
+
+# write the answer audio to a temporary .npy file that every worker memory-maps,
+# so it is never pickled. Returns the file name
+def share_answer_audio(answer_divisions):
+    answer_fd, answer_file = tempfile.mkstemp(suffix='.npy')
+    with os.fdopen(answer_fd, 'wb') as f:
+        np.save(f, answer_divisions)
+    return answer_file
+
+# Computes the errors of a batch of genes against the answer audio of their divisions
+# (decimated <decimation> times), rendering batch_size segments at a time. The time spent
+# rendering and comparing goes to timer
+def division_errors(freqs, phases, division_indices, answer_divisions, n_samples, sample_rate, byte_depth, n_channels, bpm, division, cache=None, batch_size=256, decimation=1, timer=None):
+    min_time, number_of_smallest_divisions, samples_per_division = division_layout(n_samples, sample_rate, bpm, division)
+    timer = timer or PhaseTimer()
+    if cache is not None:
+        return cached_division_errors(freqs, phases, division_indices, answer_divisions, cache, min_time, samples_per_division, byte_depth, n_channels, decimation, timer)
+    errors = np.empty(len(freqs), dtype=np.int64)
+    for start in range(0, len(freqs), batch_size):
+        end = start + batch_size
+        with timer.phase('render'):
+            segments = np.repeat(render_segments(freqs[start:end], phases[start:end], min_time, samples_per_division, byte_depth, decimation), n_channels, axis=1)
+        with timer.phase('fitness'):
+            errors[start:end] = fitness(segments, answer_divisions[division_indices[start:end]], byte_depth)
+    return errors
+
+# errors of a batch of genes, looking segments and errors up in the segment cache
+def cached_division_errors(freqs, phases, division_indices, answer_divisions, cache, min_time, samples_per_division, byte_depth, n_channels, decimation=1, timer=None):
+    timer = timer or PhaseTimer()
+    errors = np.empty(len(freqs), dtype=np.int64)
+    steps = quantize_phase(phases, cache.phase_steps)
+    for i, (d, freq, step) in enumerate(zip(division_indices, freqs, steps)):
+        error_key = ('error', float(freq), int(step), int(d), decimation)
+        if cache.cache_errors:
+            error = cache.get_error(error_key)
+            if error is not None:
+                errors[i] = error
+                continue
+        segment_key = ('segment', float(freq), int(step), decimation)
+        segment = cache.get(segment_key)
+        if segment is None:
+            with timer.phase('render'):
+                segment = np.repeat(render_segments(freq, phase_of_step(step, cache.phase_steps), min_time, samples_per_division, byte_depth, decimation), n_channels)
+            cache.put(segment_key, segment, segment.nbytes)
+        with timer.phase('fitness'):
+            errors[i] = fitness(segment, answer_divisions[d], byte_depth)
+        if cache.cache_errors:
+            cache.put(error_key, int(errors[i]), 8)
+    return errors
+
+# pool entry point: renders and scores the stale divisions of a (notes, phases, stale, level)
+# job, a chunk of the population, against the shared answer audio of a resolution level. Only
+# the errors of the stale divisions (in row-major order), the cache statistics of this
+# process and the time spent rendering and comparing are sent back
+def score_job(job, **kwargs):
+    notes, phases, stale, level = job
+    answer_divisions, decimation = shared_answer_levels[level]
+    division_indices = np.nonzero(stale)[1]
+    timer = PhaseTimer()
+    errors = division_errors(note_index.frequencies[notes[stale]], phases[stale], division_indices, answer_divisions, cache=segment_cache, decimation=decimation, timer=timer, **kwargs)
+    if segment_cache is None:
+        return errors, None, timer.totals
+    return errors, (os.getpid(),) + segment_cache.stats(), timer.totals
+
+# key of a chromosome in the fitness memo
+def chromosome_key(population, row):
+    return hashlib.sha1(population.notes[row].tobytes() + population.phases[row].tobytes()).digest()
+
+# Scores the stale divisions of some rows of the population at one resolution level with
+# map_jobs (pool.map, or map to score in this process). Returns a (rows x divisions) matrix of
+# the errors of the stale divisions, 0 elsewhere.
+# The render and fitness times of the jobs go to timer, and the rest of the time map_jobs took
+# (pickling, sending and waiting) as ipc
+def map_score_jobs(map_jobs, score, population, rows, stale, level, n_chunks, cache_stats, timer):
+    level_errors = np.zeros(stale.shape, dtype=np.int64)
+    chunks = split_population(np.arange(len(rows)), n_chunks)
+    jobs = [(population.notes[rows[c]], population.phases[rows[c]], stale[c], level) for c in chunks]
+    results = map_jobs_timed(map_jobs, score, jobs, timer)
+    for c, (chunk_stale_errors, stats, job_times) in zip(chunks, results):
+        chunk_errors = level_errors[c]
+        chunk_errors[stale[c]] = chunk_stale_errors
+        level_errors[c] = chunk_errors
+        if stats is not None:
+            cache_stats[stats[0]] = stats[1:]
+    return level_errors
+
+# map_jobs(function, jobs) for jobs whose results end with the PhaseTimer totals of the job.
+# Those totals go to timer, and the part of the time map_jobs took that the jobs, running in
+# parallel, did not spend computing goes to timer as ipc
+def map_jobs_timed(map_jobs, function, jobs, timer):
+    start = time.time()
+    with timer.phase('ipc'):
+        results = map_jobs(function, jobs)
+    wall_time = time.time() - start
+    compute_time = 0.0
+    for result in results:
+        timer.merge(result[-1])
+        compute_time += sum(result[-1].values())
+    timer.add('ipc', -min(wall_time, compute_time / max(1, len(jobs))))
+    return results
+
+# Scores every division of the population whose error is unknown (-1) with map_jobs, updating
+# errors in place. With a memo (an LRUCache of error rows keyed by chromosome_key), chromosomes
+# scored in an earlier generation are looked up, and a chromosome that appears more than once
+# is only scored once.
+# With a pyramid of (level, scale, promotion ratio) screening levels, coarsest first, the
+# chromosomes are first scored at each level in turn and only the best <promotion ratio> of them
+# go on to the next one. The rest keep their unknown errors and get an estimated sum of
+# division errors in estimates (-1 for chromosomes scored at full resolution).
+# The time spent goes to timer (see map_score_jobs).
+# Returns the number of divisions scored and not scored at full resolution
+def score_population(map_jobs, score, population, errors, n_chunks, cache_stats, memo=None, pyramid=(), estimates=None, timer=None):
+    timer = timer or PhaseTimer()
+    stale_rows = np.flatnonzero((errors < 0).any(axis=1))
+    first_rows = {}
+    duplicates = []
+    if memo is not None:
+        unscored_rows = []
+        for row in stale_rows:
+            key = chromosome_key(population, row)
+            if key in first_rows:
+                duplicates.append((row, first_rows[key]))
+                continue
+            known_errors = memo.get(key)
+            if known_errors is not None:
+                errors[row] = known_errors
+                continue
+            first_rows[key] = row
+            unscored_rows.append(row)
+        stale_rows = np.array(unscored_rows, dtype=np.int64)
+    
+    # coarse-to-fine screening
+    avoided_divisions = 0
+    for level, scale, promotion_ratio in pyramid:
+        if len(stale_rows) == 0:
+            break
+        stale = errors[stale_rows] < 0
+        level_errors = map_score_jobs(map_jobs, score, population, stale_rows, stale, level, n_chunks, cache_stats, timer)
+        row_estimates = np.where(stale, 0, errors[stale_rows]).sum(axis=1) + np.round(level_errors.sum(axis=1) * scale).astype(np.int64)
+        ranked = np.argsort(row_estimates, kind='mergesort')
+        promoted = ranked[:int(math.ceil(promotion_ratio * len(ranked)))]
+        dropped = ranked[len(promoted):]
+        estimates[stale_rows[dropped]] = row_estimates[dropped]
+        avoided_divisions += int(stale[dropped].sum())
+        stale_rows = stale_rows[np.sort(promoted)]
+    
+    stale = errors[stale_rows] < 0
+    level_errors = map_score_jobs(map_jobs, score, population, stale_rows, stale, 0, n_chunks, cache_stats, timer)
+    errors[stale_rows] = np.where(stale, level_errors, errors[stale_rows])
+    for key, row in first_rows.items():
+        if estimates is None or estimates[row] < 0:
+            memo.put(key, errors[row].copy(), errors[row].nbytes + len(key))
+    for row, first_row in duplicates:
+        errors[row] = errors[first_row]
+        if estimates is not None:
+            estimates[row] = estimates[first_row]
+    return int(stale.sum()), avoided_divisions
+
+# decodes samples to floats in [-1, 1], the way fft.py reads wave files
+def float_samples(samples, byte_depth):
+    if byte_depth == 2:
+        return samples.astype(np.float32) / 32767
+    return (samples.astype(np.float32) - 128) / 128
+
+# Magnitude spectra of the first channel of every answer division, from (or put in) an
+# AnalysisCache under the name of the answer wave file when there is one
+def first_channel_spectra(cache, audio_file_name, answer_divisions, byte_depth, n_channels, window=None):
+    answer_windows = float_samples(answer_divisions.reshape(len(answer_divisions), -1, n_channels)[:, :, 0], byte_depth)
+    return cached_spectra(cache, audio_file_name, answer_windows, window)
+
+# Spectral fitness: compares the magnitude spectrum of every division (of the first channel)
+# with the magnitude spectrum of each note, which makes the phase of a gene irrelevant. As a
+# gene's segment then only depends on its note, the errors of every note against every division
+# are computed once, as a (notes x divisions) table of summed absolute magnitude differences
+# (in thousandths, to keep errors integers). answer_spectra are the first_channel_spectra of
+# the answer with the same window, computed when not given
+def spectral_error_table(answer_divisions, n_samples, sample_rate, byte_depth, n_channels, bpm, division, window=None, block_divisions=32, answer_spectra=None):
+    min_time, number_of_smallest_divisions, samples_per_division = division_layout(n_samples, sample_rate, bpm, division)
+    if answer_spectra is None:
+        answer_spectra = first_channel_spectra(None, None, answer_divisions, byte_depth, n_channels, window)
+    note_segments = render_segments(note_index.frequencies, np.zeros(len(note_index.frequencies)), min_time, samples_per_division, byte_depth)
+    note_spectra = division_spectra(float_samples(note_segments, byte_depth), window)
+    error_table = np.empty((len(note_spectra), len(answer_spectra)), dtype=np.int64)
+    for start in range(0, len(answer_spectra), block_divisions):
+        block = answer_spectra[start:start + block_divisions]
+        error_table[:, start:start + block_divisions] = np.round(1000 * np.abs(note_spectra[:, np.newaxis, :] - block[np.newaxis, :, :]).sum(axis=2))
+    return error_table
+
+# Fills in the unknown (-1) division errors of a population from a (notes x divisions) error
+# table, in place. Returns the number of divisions looked up
+def table_errors(population, errors, error_table):
+    stale = errors < 0
+    errors[stale] = error_table[population.notes[stale], np.nonzero(stale)[1]]
+    return int(stale.sum())
+
+# Selection methods: each picks <n> parents (as population rows), given the fitnesses and
+# the rows sorted from best to worst
+
+# cycle through the best sixth of the population
+def truncation_selection(fitnesses, order, n, rng):
+    best = order[:max(1, len(order) // 6)]
+    return np.repeat(best, -(-n // len(best)))[:n]
+
+# the fittest of <tournament_size> random chromosomes, for each parent
+def tournament_selection(fitnesses, order, n, rng, tournament_size=3):
+    entrants = rng.randint(len(order), size=(n, tournament_size))
+    return entrants[np.arange(n), np.argmin(fitnesses[entrants], axis=1)]
+
+# random chromosomes, weighted linearly by rank (the best is picked len(order) times as often as the worst)
+def rank_selection(fitnesses, order, n, rng):
+    weights = np.arange(len(order), 0, -1, dtype=np.float64)
+    return order[rng.choice(len(order), size=n, p=weights / weights.sum())]
+
+selection_methods = {'truncation': truncation_selection,
+                     'tournament': tournament_selection,
+                     'rank': rank_selection}
+
+def selection_method(name, tournament_size):
+    if name == 'tournament':
+        return partial(tournament_selection, tournament_size=tournament_size)
+    return selection_methods[name]
+
+# fitness of every chromosome: the sum of its division errors, or its estimate from coarse
+# screening, plus the padding error
+def population_fitnesses(errors, estimates, padding_error):
+    return np.where(estimates >= 0, estimates, errors.sum(axis=1)) + padding_error
+
+# Row of the fittest chromosome whose every division is scored (screened out chromosomes only
+# have an estimated fitness), or None if there is none
+def best_scored_row(errors, fitnesses):
+    scored = np.flatnonzero((errors >= 0).all(axis=1))
+    if len(scored) == 0:
+        return None
+    return scored[np.argmin(fitnesses[scored])]
+
+# Why the run should stop after <generation> generations, or None if it should go on
+def termination_reason(args, start_time, generation, best_fitness, converged_generation):
+    if args['target_fitness'] is not None and best_fitness <= args['target_fitness']:
+        return 'target fitness of %d reached' % args['target_fitness']
+    if args['time_limit'] is not None and time.time() - start_time >= args['time_limit']:
+        return 'time limit of %s reached' % datetime.timedelta(seconds=int(args['time_limit']))
+    if args['stagnation'] is not None and generation - converged_generation >= args['stagnation']:
+        return 'no improvement in %d generations' % (generation - converged_generation)
+    if args['generations'] is not None and generation >= args['generations']:
+        return 'all %d generations completed' % args['generations']
+    return None
+
+# Writes the metrics of a generation (or a run of island generations) that took <seconds>: the
+# time spent in each phase since the last one, the fitnesses and diversity of the population and
+# the number of full resolution samples scored per second
+def write_generation_metrics(metrics, timer, generation, seconds, population, fitnesses, scored_divisions, samples_per_division):
+    metrics.write('generation', generation=generation, seconds=seconds, phases=timer.reset(),
+                  fitness=summary(fitnesses), diversity=population_diversity(population.notes), divisions_scored=scored_divisions,
+                  samples_per_second=scored_divisions * samples_per_division / seconds if seconds > 0 else None)
+
+# Breeds the next generation: the elites, two mutants and two crossovers per elite (parents
+# picked by select, crossover partners at random) and lucky survivors. Elites and survivors
+# keep their errors, children keep the errors of unchanged genes.
+# Returns the new population and its errors, -1 where a division has to be scored again
+# number of elites and lucky survivors that keep a population at <size>: the best sixth are
+# elites, each with two mutants and two crossovers, and survivors fill the rest (a population
+# of fewer than 5 grows to 5)
+def breeding_counts(size):
+    n_elites = max(1, size // 6)
+    return n_elites, max(0, size - 5 * n_elites)
+
+def BreedGeneration(population, errors, fitnesses, select, n_elites, n_survivors, mutation_rate, mutate_phases, rng):
+    order = np.argsort(fitnesses, kind='mergesort')
+    elites = order[:n_elites]
+    
+    # mutate a couple per elite
+    mutated_parents = select(fitnesses, order, 2 * n_elites, rng)
+    mutants = MutatePopulation(population.take(mutated_parents), mutation_rate, rng, mutate_phases)
+    
+    # cross a couple over per elite, each with a random partner
+    crossed_parents = select(fitnesses, order, 2 * n_elites, rng)
+    partners = rng.randint(len(population), size=len(crossed_parents))
+    crossed = CrossoverPopulations(population.take(crossed_parents), population.take(partners), rng)
+    
+    # pick random ones (lucky survivors)
+    survivors = rng.randint(len(population), size=n_survivors)
+    
+    new_population = concatenate_populations([population.take(elites), mutants, crossed, population.take(survivors)])
+    new_errors = np.concatenate([errors[elites],
+                                 inherit_errors(mutants, [population.take(mutated_parents)], [errors[mutated_parents]]),
+                                 inherit_errors(crossed, [population.take(crossed_parents), population.take(partners)], [errors[crossed_parents], errors[partners]]),
+                                 errors[survivors]])
+    return new_population, new_errors
+
+# pool entry point of the island model: evolves one (population, errors, fitnesses, rng) island
+# for settings['generations'] generations on its own, scoring in this process.
+# Returns the island, the number of divisions scored and avoided at full resolution, the
+# cache statistics of this process, the number of generations run and the time spent in each phase
+def evolve_island(job):
+    island, settings = job
+    population, errors, fitnesses, rng = island
+    n_elites, n_survivors = breeding_counts(len(population))
+    timer = PhaseTimer()
+    select = timer.timed('selection', selection_method(settings['selection'], settings['tournament_size']))
+    cache_stats = {}
+    scored_divisions = 0
+    avoided_divisions = 0
+    generations = 0
+    while generations < settings['generations']:
+        if settings['deadline'] is not None and time.time() >= settings['deadline']:
+            break
+        if settings['target_fitness'] is not None:
+            best = best_scored_row(errors, fitnesses)
+            if best is not None and fitnesses[best] <= settings['target_fitness']:
+                break
+        generations += 1
+        with timer.phase('breeding'):
+            population, errors = BreedGeneration(population, errors, fitnesses, select, n_elites, n_survivors, settings['mutation_rate'], settings['error_table'] is None, rng)
+        estimates = np.full(len(population), -1, dtype=np.int64)
+        with timer.phase('scoring'):
+            if settings['error_table'] is not None:
+                with timer.phase('fitness'):
+                    scored_divisions += table_errors(population, errors, settings['error_table'])
+            else:
+                scored, avoided = score_population(map, settings['score'], population, errors, 1, cache_stats, fitness_memo, settings['pyramid'], estimates, timer)
+                scored_divisions += scored
+                avoided_divisions += avoided
+            fitnesses = population_fitnesses(errors, estimates, settings['padding_error'])
+    cache_report = None
+    if segment_cache is not None:
+        cache_report = (os.getpid(),) + segment_cache.stats()
+    return (population, errors, fitnesses, rng), scored_divisions, avoided_divisions, cache_report, generations, timer.totals
+
+# island topologies: the islands each island sends its best chromosomes to
+migration_topologies = {'ring': lambda i, n: [(i + 1) % n],
+                        'all': lambda i, n: [j for j in range(n) if j != i]}
+
+# Copies the <n_migrants> best chromosomes of every island, with their errors and fitnesses,
+# over the topology to other islands, where they replace the worst chromosomes
+def migrate(islands, n_migrants, topology):
+    migrants = []
+    for population, errors, fitnesses, rng in islands:
+        best = np.argsort(fitnesses, kind='mergesort')[:n_migrants]
+        migrants.append((population.take(best), errors[best], fitnesses[best]))
+    incoming = [[] for island in islands]
+    for i in range(len(islands)):
+        for j in migration_topologies[topology](i, len(islands)):
+            incoming[j].append(migrants[i])
+    new_islands = []
+    for (population, errors, fitnesses, rng), arrivals in zip(islands, incoming):
+        if arrivals:
+            # the best chromosome of an island is never replaced
+            n_arrivals = min(sum(len(a[2]) for a in arrivals), len(population) - 1)
+            worst = np.argsort(fitnesses, kind='mergesort')[len(population) - n_arrivals:]
+            arriving = concatenate_populations([a[0] for a in arrivals]).take(np.arange(n_arrivals))
+            population = population.take(np.arange(len(population)))
+            population.notes[worst] = arriving.notes
+            population.phases[worst] = arriving.phases
+            errors = errors.copy()
+            errors[worst] = np.concatenate([a[1] for a in arrivals])[:n_arrivals]
+            fitnesses = fitnesses.copy()
+            fitnesses[worst] = np.concatenate([a[2] for a in arrivals])[:n_arrivals]
+        new_islands.append((population, errors, fitnesses, rng))
+    return new_islands
+
+# per-division errors of children, copied from the parents (row by row) wherever a gene is
+# unchanged, -1 where the division has to be scored again
+def inherit_errors(children, parents, parent_errors):
+    errors = np.full(children.notes.shape, -1, dtype=np.int64)
+    for parent, parent_error in zip(parents, parent_errors):
+        unchanged = (children.notes == parent.notes) & (children.phases == parent.phases) & (errors < 0)
+        errors[unchanged] = parent_error[unchanged]
+    return errors
+
+# A population of chromosomes, genes being:
+#   note (index into note_index, uint8)
+#   phase (float32)
+# stored as two (population x divisions) matrices
+class Population(object):
+    def __init__(self, notes, phases):
+        self.notes = notes
+        self.phases = phases
+
+    def __len__(self):
+        return len(self.notes)
+
+    def take(self, rows):
+        return Population(self.notes[rows], self.phases[rows])
+
+    # the (freq, phase) genes of one chromosome
+    def chromosome(self, row):
+        return zip(note_index.frequencies[self.notes[row]].tolist(), self.phases[row].tolist())
+
+def concatenate_populations(populations):
+    return Population(np.concatenate([p.notes for p in populations]), np.concatenate([p.phases for p in populations]))
+
+# Diversity of the notes of a population: the chance that two random chromosomes have a
+# different note in a division, averaged over the divisions (0 when they are all the same)
+def population_diversity(notes):
+    n_notes = len(note_index.frequencies)
+    counts = np.bincount((notes + n_notes * np.arange(notes.shape[1])).ravel(), minlength=n_notes * notes.shape[1])
+    shares = counts.reshape(notes.shape[1], n_notes) / float(len(notes))
+    return float(np.mean(1 - (shares ** 2).sum(axis=1)))
+
+def random_phases(shape, rng):
+    return ((2 * math.pi * rng.random_sample(shape)) - math.pi).astype(np.float32)
+
+# Creates a population of <size> random chromosomes
+def GeneratePopulation(size, n_samples, sample_rate, bpm, division, rng):
+    min_time, number_of_smallest_divisions, samples_per_division = division_layout(n_samples, sample_rate, bpm, division)
+    shape = (size, int(number_of_smallest_divisions))
+    return Population(rng.randint(len(note_index.frequencies), size=shape).astype(np.uint8), random_phases(shape, rng))
+
+# Creates a population of <size> chromosomes seeded from an fft analysis of the answer audio:
+# the note of each division is drawn from the top_k strongest notes of that division (of the
+# first channel), weighted by their magnitude. answer_spectra are the first_channel_spectra of
+# the answer (without a window), computed when not given
+def SeedPopulation(size, answer_divisions, n_samples, sample_rate, byte_depth, n_channels, bpm, division, top_k, rng, answer_spectra=None):
+    min_time, number_of_smallest_divisions, samples_per_division = division_layout(n_samples, sample_rate, bpm, division)
+    if answer_spectra is None:
+        answer_spectra = first_channel_spectra(None, None, answer_divisions, byte_depth, n_channels)
+    peak_freqs, magnitudes = find_peaks_batch(answer_spectra, answer_divisions.shape[1] // n_channels // 2, min_time, top_k)
+    candidates = note_index.nearest(peak_freqs)
+    weights = np.cumsum(magnitudes, axis=1)
+    weights /= np.maximum(weights[:, -1:], 1e-12)
+    draws = rng.random_sample((size, len(candidates)))
+    picks = np.minimum((draws[:, :, np.newaxis] > weights[np.newaxis, :, :]).sum(axis=2), candidates.shape[1] - 1)
+    notes = candidates[np.arange(len(candidates)), picks].astype(np.uint8)
+    return Population(notes, random_phases(notes.shape, rng))
+
+# time in seconds of each division, number of divisions and samples per division
+def division_layout(n_samples, sample_rate, bpm, division):
     min_time = 60.0 / (bpm * division)
     total_time = float(n_samples) / sample_rate
     number_of_smallest_divisions = total_time / min_time
     samples_per_division = n_samples / number_of_smallest_divisions
-    
-    chromo = []
-    audio_data = []
-    for gene in chromosome:
-        freq = gene[0]
-        phase = gene[1]
-        for s in range(int(samples_per_division)):
-            s_time = (min_time * s) / samples_per_division
-            sample_val = 0
-            if byte_depth == 1:
-                sample_val = int(127 * (math.sin((2*math.pi*freq*s_time) + phase) + (0.5 * math.sin((4*math.pi*freq*s_time) + phase)) + (0.25 * math.sin((6*math.pi*freq*s_time) + phase))) / 1.75) + 128
-                if n_channels == 1:
-                    audio_data.append(sample_val)
-                else:
-                    audio_data.append(sample_val)
-                    audio_data.append(sample_val)
-            else:
-                sample_val = int(32767 * (math.sin((2*math.pi*freq*s_time) + phase) + (0.5 * math.sin((4*math.pi*freq*s_time) + phase)) + (0.25 * math.sin((6*math.pi*freq*s_time) + phase))) / 1.75)
-                val = struct.pack('h', sample_val)
-                if n_channels == 1:
-                    audio_data.append(ord(val[0]))
-                    audio_data.append(ord(val[1]))
-                else:
-                    audio_data.append(ord(val[0]))
-                    audio_data.append(ord(val[1]))
-                    audio_data.append(ord(val[0]))
-                    audio_data.append(ord(val[1]))
-    missing = (n_samples*byte_depth*n_channels) - len(audio_data)
-    for i in range(missing):
-        audio_data.append(128)
-    return audio_data
-
-# take audio data and convert it to the format the wave library likes
-def ConvertBackToSamples(audio_data):
-    return ''.join(chr(b) for b in audio_data)
-    
-# randomly change <mutation rate> genes
-def MutateChromosome(chromosome,mutation_rate):
-    new_chromosome = []
-    for gene in chromosome:
-        freq =  gene[0]
-        phase = gene[1]
-        if random.random() < mutation_rate:
-            freq = random.choice(frequencies.values())
-        if random.random() < mutation_rate:
-            phase = (2 * math.pi * random.random()) - math.pi
-        new_chromosome.append((freq, phase))
-    return new_chromosome
+    return min_time, number_of_smallest_divisions, samples_per_division
+
+# numpy type of a single sample in the wave file
+def sample_dtype(byte_depth):
+    if byte_depth == 2:
+        return np.dtype('<i2')
+    return np.dtype(np.uint8)
+
+# sample values of a batch of genes, one row of samples_per_division samples per gene
+# (fundamental plus 2nd and 3rd harmonics, all sharing the gene's phase)
+# With a decimation, only every <decimation>th sample is rendered and harmonics above the
+# nyquist frequency of that lower rate are left out, so the segment is band-limited
+def render_segments(freqs, phases, min_time, samples_per_division, byte_depth, decimation=1):
+    s_time = (min_time * np.arange(0, int(samples_per_division), decimation)) / samples_per_division
+    freqs = np.asarray(freqs, dtype=np.float64)[..., np.newaxis]
+    phases = np.asarray(phases, dtype=np.float64)[..., np.newaxis]
+    if decimation == 1:
+        wave_sum = np.sin((2*math.pi*freqs*s_time) + phases) + (0.5 * np.sin((4*math.pi*freqs*s_time) + phases)) + (0.25 * np.sin((6*math.pi*freqs*s_time) + phases))
+    else:
+        nyquist = samples_per_division / (2 * min_time * decimation)
+        wave_sum = sum(weight * (harmonic * freqs < nyquist) * np.sin((2*math.pi*harmonic*freqs*s_time) + phases) for harmonic, weight in ((1, 1.0), (2, 0.5), (3, 0.25)))
+    if byte_depth == 1:
+        return ((127 * wave_sum / 1.75).astype(np.int64) + 128).astype(np.uint8)
+    return (32767 * wave_sum / 1.75).astype(np.int16)
+
+# Converts a chromosome to audio data, as blocks of bytes of whole divisions, at most
+# block_frames frames long unless a single division is longer, followed by the padding of 128
+# bytes past the last full division
+def chromosome_audio_blocks(chromosome, n_samples, sample_rate, byte_depth, n_channels, bpm, division, block_frames=65536):
+    min_time, number_of_smallest_divisions, samples_per_division = division_layout(n_samples, sample_rate, bpm, division)
+    genes = np.asarray(chromosome, dtype=np.float64).reshape(-1, 2)
+    block_divisions = max(1, block_frames // max(1, int(samples_per_division)))
+    remaining = n_samples * n_channels * byte_depth
+    for start in range(0, len(genes), block_divisions):
+        segments = render_segments(genes[start:start + block_divisions, 0], genes[start:start + block_divisions, 1], min_time, samples_per_division, byte_depth)
+        block = np.repeat(segments.ravel(), n_channels).astype(sample_dtype(byte_depth)).tobytes()
+        remaining -= len(block)
+        yield block
+    while remaining > 0:
+        padding = min(remaining, block_frames * n_channels * byte_depth)
+        remaining -= padding
+        yield b'\x80' * padding
+
+# fitness of audio given as consecutive blocks of bytes, scored one block at a time
+def blocks_fitness(blocks, answer_audio, byte_depth):
+    answer_audio = as_samples(answer_audio, byte_depth)
+    fitness_score = 0
+    position = 0
+    for block in blocks:
+        block_samples = as_samples(block, byte_depth)
+        fitness_score += fitness(block_samples, answer_audio[position:position + len(block_samples)], byte_depth)
+        position += len(block_samples)
+    return fitness_score
+
+# split a population into <n> contiguous chunks, one per process
+def split_population(chromosomes, n):
+    chunk_size = max(1, -(-len(chromosomes) // n))
+    return [chromosomes[i:i+chunk_size] for i in range(0, len(chromosomes), chunk_size)]
+
+# randomly change <mutation rate> of the notes and of the phases of every chromosome
+def MutatePopulation(population, mutation_rate, rng, mutate_phases=True):
+    notes = population.notes.copy()
+    phases = population.phases.copy()
+    mutated = rng.random_sample(notes.shape) < mutation_rate
+    notes[mutated] = rng.randint(len(note_index.frequencies), size=np.count_nonzero(mutated))
+    if mutate_phases:
+        mutated = rng.random_sample(phases.shape) < mutation_rate
+        phases[mutated] = random_phases(np.count_nonzero(mutated), rng)
+    return Population(notes, phases)
         
-# take two chromosomes, make a mix of the two
-def CrossoverChromosomes(chromosome1,chromosome2):
-    new_chromosome = []
-    for gene1,gene2 in zip(chromosome1, chromosome2):
-        if random.random() < 0.5:
-            freq = gene1[0]
-        else:
-            freq = gene2[0]
-        if random.random() < 0.5:
-            phase = gene1[1]
-        else:
-            phase = gene2[1]
-        new_chromosome.append((freq,phase))
-    return new_chromosome
+# take two populations, make a gene by gene mix of each pair of chromosomes
+def CrossoverPopulations(population1, population2, rng):
+    notes = np.where(rng.random_sample(population1.notes.shape) < 0.5, population1.notes, population2.notes)
+    phases = np.where(rng.random_sample(population1.phases.shape) < 0.5, population1.phases, population2.phases)
+    return Population(notes, phases)
 
 # Use argparse to create command line options
 def ParseArguments():
@@ -204,22 +757,91 @@ def ParseArguments():
     parser.add_argument('divisions', type=int, help='The largest number of divisions of a beat, e.g. if the music contains 16th notes, they (usually) divide the beat by 4')
     parser.add_argument('-p', '--max-processes', type=int, help='Max number of threads to at once (default 2)')
     parser.add_argument('-i', '--initial-population', type=int, help='The size of the initial population (default 30)')
-    parser.add_argument('-g', '--generations', type=int, help='The number of generations to complete')
-    parser.add_argument('-m', '--mutation-rate', help='How often genes change. Give as a decimal less than 1, e.g. 0.2')
+    parser.add_argument('-g', '--generations', type=int, help='The number of generations to complete (default 20, or no limit when another stopping condition is given)')
+    parser.add_argument('-t', '--time-limit', type=float, help='Stop after this many seconds of wall clock time (default none)')
+    parser.add_argument('--target-fitness', type=int, help='Stop once the best fitness is at or below this (default none)')
+    parser.add_argument('--stagnation', type=int, help='Stop when the best fitness has not improved for this many generations (default none)')
+    parser.add_argument('-o', '--output-file', help='The wave file the best chromosome is written to (default export.wav)')
+    parser.add_argument('-b', '--block-frames', type=int, help='Frames of audio rendered and written at a time when exporting (default 65536)')
+    parser.add_argument('--metrics-file', help='Write a JSON line per generation, with the time spent rendering, scoring (fitness), sending jobs to the pool (ipc), in selection and breeding, the fitnesses, diversity and throughput, to this file')
+    parser.add_argument('--profile', help='Dump cProfile stats of the main process to this file')
+    parser.add_argument('-m', '--mutation-rate', type=float, help='How often genes change. Give as a decimal less than 1, e.g. 0.2')
+    parser.add_argument('--selection', choices=sorted(selection_methods.keys()), help='How parents are picked for mutation and crossover (default truncation, the best sixth)')
+    parser.add_argument('--tournament-size', type=int, help='Number of chromosomes in each tournament of tournament selection (default 3)')
+    parser.add_argument('--memo-size', type=float, help='Memory budget of the memo of already scored chromosomes in MB (default 64, 0 for none)')
+    parser.add_argument('--pyramid', help='Comma separated decimation factors of coarse screening levels, e.g. 8,2 (default none, every chromosome is scored at full resolution)')
+    parser.add_argument('--promote', help='Comma separated fraction of chromosomes promoted from each screening level to the next, e.g. 0.25,0.5 (default 0.25 for every level)')
+    parser.add_argument('-f', '--fitness', choices=['time', 'spectral'], help='Compare raw samples (time, the default) or the magnitude spectrum of each division (spectral, which ignores and does not search phase)')
+    parser.add_argument('--spectral-window', choices=sorted(window_functions.keys()), help='Window function applied to each division before its spectrum is taken (default hann)')
+    parser.add_argument('--fft-seed-fraction', type=float, help='Fraction of the initial population seeded from an fft analysis of the audio, the rest is random (default 0)')
+    parser.add_argument('--fft-top-k', type=int, help='Number of strongest notes per division that seeded chromosomes draw from (default 5)')
+    parser.add_argument('--islands', type=int, help='Split the population into this many islands that evolve independently in the worker processes, at most a fifth of the initial population (default 0, no islands)')
+    parser.add_argument('--migration-interval', type=int, help='Generations between migrations between islands (default 5)')
+    parser.add_argument('--migrants', type=int, help='Number of best chromosomes each island sends to its neighbours at a migration (default 2)')
+    parser.add_argument('--topology', choices=sorted(migration_topologies.keys()), help='Which islands each island sends migrants to (default ring)')
+    parser.add_argument('-s', '--seed', type=int, help='Seed for the random number generator (default random)')
+    parser.add_argument('--analysis-cache', help='Directory of a cache of the spectra used for seeding and the spectral fitness (shared with fft.py), so they are not computed again for the same file')
+    parser.add_argument('--analysis-cache-size', type=float, help='Disk budget of the analysis cache in MB (default 1024)')
+    parser.add_argument('-c', '--cache-size', type=float, help='Memory budget of the gene segment cache of each process in MB (default 0, no cache)')
+    parser.add_argument('-q', '--phase-steps', type=int, help='Number of steps phases are quantized to when the segment cache is on (default 64)')
+    parser.add_argument('--cache-errors', action='store_true', help='Also cache the error of each segment against each division')
     argNamespace = parser.parse_args()
     args = vars(argNamespace)
     if args['max_processes'] is None:
         args['max_processes'] = 2
     if args['initial_population'] is None:
         args['initial_population'] = 30
-    if args['generations'] is None:
+    if args['generations'] is None and args['time_limit'] is None and args['target_fitness'] is None and args['stagnation'] is None:
         args['generations'] = 20
+    if args['output_file'] is None:
+        args['output_file'] = 'export.wav'
+    if args['block_frames'] is None:
+        args['block_frames'] = 65536
     if args['mutation_rate'] is None:
         args['mutation_rate'] = 0.25
+    if args['selection'] is None:
+        args['selection'] = 'truncation'
+    if args['tournament_size'] is None:
+        args['tournament_size'] = 3
+    if args['memo_size'] is None:
+        args['memo_size'] = 64
+    args['pyramid'] = sorted([int(d) for d in (args['pyramid'] or '').split(',') if d], reverse=True)
+    promote = [float(r) for r in (args['promote'] or '').split(',') if r]
+    if any(not 0 < r <= 1 for r in promote):
+        parser.error('--promote ratios must be more than 0 and at most 1, else no chromosome reaches full resolution')
+    args['promote'] = (promote + [promote[-1] if promote else 0.25] * len(args['pyramid']))[:len(args['pyramid'])]
+    if args['fitness'] is None:
+        args['fitness'] = 'time'
+    if args['spectral_window'] is None:
+        args['spectral_window'] = 'hann'
+    if args['fft_seed_fraction'] is None:
+        args['fft_seed_fraction'] = 0
+    if args['fft_top_k'] is None:
+        args['fft_top_k'] = 5
+    if args['islands'] is None:
+        args['islands'] = 0
+    if 5 * args['islands'] > args['initial_population']:
+        parser.error('--islands (%d) needs an initial population of at least %d, every island breeds an elite, two mutants and two crossovers' % (args['islands'], 5 * args['islands']))
+    if args['migration_interval'] is None:
+        args['migration_interval'] = 5
+    if args['migrants'] is None:
+        args['migrants'] = 2
+    if args['topology'] is None:
+        args['topology'] = 'ring'
+    if args['cache_size'] is None:
+        args['cache_size'] = 0
+    if args['analysis_cache_size'] is None:
+        args['analysis_cache_size'] = 1024
+    if args['phase_steps'] is None:
+        args['phase_steps'] = 64
     return args
     
 def RunGenerations():
     args = ParseArguments()
+    profiler = start_profile(args['profile'])
+    metrics = MetricsWriter(args['metrics_file'])
+    timer = PhaseTimer()
+    run_timer = PhaseTimer()
     audio_file_name = args['file']
     bpm = args['bpm']
     divisions = args['divisions']
@@ -232,89 +854,209 @@ def RunGenerations():
     print 'Number of channels: %d' % n_channels
     print 'Sample width (bytes): %d' % byte_depth
     print 'Initial Population Size: %d' % args['initial_population']
-    print 'Number of Generations: %d' % args['generations']
+    print 'Number of Generations: %s' % (args['generations'] if args['generations'] is not None else 'no limit')
     audio_data_string = audio_file.readframes(n_frames)
     framerate = audio_file.getframerate()
     
-    audio_data = []
-    for sample in audio_data_string:
-        audio_data.append(ord(sample))
-    chromosomes = []
-    test_datas = []
-    fitnesses = []
+    audio_data = as_samples(audio_data_string, byte_depth)
+    answer_divisions, padding_error = split_answer_audio(audio_data, n_frames, framerate, byte_depth, n_channels, bpm, divisions)
+    answer_levels = [answer_divisions]
+    for decimation in args['pyramid']:
+        answer_levels.append(decimate_answer_audio(audio_data, n_frames, framerate, byte_depth, n_channels, bpm, divisions, decimation))
+    # (level, scale, promotion ratio) of each screening level, scale being how many full
+    # resolution samples each decimated sample stands for
+    pyramid = [(level, answer_divisions.shape[1] / float(answer_levels[level].shape[1]), promotion_ratio)
+               for level, promotion_ratio in zip(range(1, len(answer_levels)), args['promote'])]
+    score = partial(score_job, n_samples=n_frames, sample_rate=framerate, byte_depth=byte_depth, n_channels=n_channels, bpm=bpm, division=divisions)
+    rng = np.random.RandomState(args['seed'])
+    analysis_cache = None
+    if args['analysis_cache'] is not None:
+        analysis_cache = AnalysisCache(args['analysis_cache'], int(args['analysis_cache_size'] * 1024 * 1024))
+    error_table = None
+    if args['fitness'] == 'spectral':
+        print 'Fitness: spectral (phase is not searched)'
+        answer_spectra = first_channel_spectra(analysis_cache, audio_file_name, answer_divisions, byte_depth, n_channels, args['spectral_window'])
+        error_table = spectral_error_table(answer_divisions, n_frames, framerate, byte_depth, n_channels, bpm, divisions, args['spectral_window'], answer_spectra=answer_spectra)
+        padding_error = 0
+    select = timer.timed('selection', selection_method(args['selection'], args['tournament_size']))
+    memo = None
+    memo_bytes = 0
+    if args['memo_size'] > 0 and args['fitness'] == 'time':
+        memo_bytes = int(args['memo_size'] * 1024 * 1024)
+        memo = LRUCache(memo_bytes)
     
-    print 'Use ^C to exit, it will wait for the current generation to finish.'
-    pool = Pool(args['max_processes'], init_worker)
+    # with islands, each island is a share of the population and breeds to its own size
+    population_size = args['initial_population']
+    n_islands = args['islands']
+    n_elites, n_survivors = breeding_counts(population_size)
+    
+    print 'Use ^C to exit, it will export the best chromosome so far.'
+    cache_bytes = int(args['cache_size'] * 1024 * 1024)
+    cache_stats = {}
+    total_avoided = 0
+    best_chromosome = None
+    answer_files = [share_answer_audio(answer_level) for answer_level in answer_levels]
+    pool = Pool(args['max_processes'], init_worker, (zip(answer_files, [1] + args['pyramid']), cache_bytes, args['phase_steps'], args['cache_errors'], memo_bytes))
     try:
         # generate initial population
         print 'Generating Initial Population...'
         start_time = time.time()
-        for i in range(args['initial_population']): # initial population size
-            chromosome = GenerateChromosome(n_frames, framerate, bpm, divisions)
-            chromosomes.append(chromosome)
-        test_datas = pool.map(partial(generate_random_audio, n_samples=n_frames, sample_rate=framerate, byte_depth=byte_depth, n_channels=n_channels, bpm=bpm, division=divisions), chromosomes)
+        n_seeded = int(round(args['fft_seed_fraction'] * population_size))
+        if n_seeded > 0:
+            seed_spectra = first_channel_spectra(analysis_cache, audio_file_name, answer_divisions, byte_depth, n_channels)
+            population = concatenate_populations([SeedPopulation(n_seeded, answer_divisions, n_frames, framerate, byte_depth, n_channels, bpm, divisions, args['fft_top_k'], rng, seed_spectra),
+                                                  GeneratePopulation(population_size - n_seeded, n_frames, framerate, bpm, divisions, rng)])
+            print 'Seeded %d chromosomes from the fft analysis' % n_seeded
+        else:
+            population = GeneratePopulation(population_size, n_frames, framerate, bpm, divisions, rng)
+        errors = np.full(population.notes.shape, -1, dtype=np.int64)
+        estimates = np.full(len(population), -1, dtype=np.int64)
+        with timer.phase('scoring'):
+            if error_table is not None:
+                population.phases[:] = 0
+                with timer.phase('fitness'):
+                    stale_divisions = table_errors(population, errors, error_table)
+            else:
+                stale_divisions = score_population(pool.map, score, population, errors, args['max_processes'], cache_stats, memo, pyramid, estimates, timer)[0]
+            fitnesses = population_fitnesses(errors, estimates, padding_error)
+        run_timer.merge(timer.totals)
+        write_generation_metrics(metrics, timer, 0, time.time() - start_time, population, fitnesses, stale_divisions, answer_divisions.shape[1])
+        best = best_scored_row(errors, fitnesses)
+        if best is None:
+            # no chromosome was scored at full resolution, start from the best estimate
+            best = int(np.argmin(fitnesses))
+        best_chromosome, best_fitness = population.take([best]), fitnesses[best]
+        converged_generation = 0
+        gen = 0
         
-        fitnesses = pool.map(partial(fitness, answer_audio=audio_data, byte_depth=byte_depth), test_datas)   
-
-        # run populations
-        new_chromosomes = []
-        new_test_datas = []
-        new_fitnesses = []
-        for gen in range(args['generations']): # number of populations
-            current_time = time.time()
-            print 'Elapsed Time: %s' % (datetime.timedelta(seconds=int(current_time - start_time)))
-            print 'Running Generation #%d' % (gen+1)
-            sorted_fitnesses = sorted(fitnesses)
-            sorted_chromosomes = []
-            for f in sorted_fitnesses:
-                c_index = fitnesses.index(f)
-                sorted_chromosomes.append(chromosomes[c_index])
-            for c in sorted_chromosomes[:len(sorted_chromosomes)//(args['initial_population']//6)]:
-                chromosome = c
-                new_chromosomes.append(chromosome)
-                
-                # mutate a couple
-                for i in range(2):
-                    chromosome = MutateChromosome(c, args['mutation_rate'])
-                    new_chromosomes.append(chromosome)
-                    
-                # cross a couple over with it
-                for i in range(2):
-                    chromosome = CrossoverChromosomes(c, random.choice(sorted_chromosomes))
-                    new_chromosomes.append(chromosome)
-                    
-                # pick a random one (lucky survivor)
-                chromosome = random.choice(sorted_chromosomes)
-                new_chromosomes.append(chromosome)
-                
-            new_test_datas = pool.map(partial(generate_random_audio, n_samples=n_frames, sample_rate=framerate, byte_depth=byte_depth, n_channels=n_channels, bpm=bpm, division=divisions), new_chromosomes)
+        if n_islands > 0:
+            # island model: every island evolves on its own for migration_interval generations,
+            # then the best chromosomes of each migrate to its neighbours
+            shuffled = rng.permutation(len(population))
+            islands = []
+            for rows in np.array_split(shuffled, n_islands):
+                islands.append((population.take(rows), errors[rows], fitnesses[rows], np.random.RandomState(rng.randint(2**31))))
+            island_settings = {'selection': args['selection'], 'tournament_size': args['tournament_size'],
+                               'mutation_rate': args['mutation_rate'],
+                               'error_table': error_table, 'score': score, 'pyramid': pyramid, 'padding_error': padding_error,
+                               'target_fitness': args['target_fitness'],
+                               'deadline': start_time + args['time_limit'] if args['time_limit'] is not None else None}
+            stop_reason = termination_reason(args, start_time, gen, best_fitness, converged_generation)
+            while stop_reason is None:
+                island_settings['generations'] = args['migration_interval']
+                if args['generations'] is not None:
+                    island_settings['generations'] = min(island_settings['generations'], args['generations'] - gen)
+                if args['stagnation'] is not None:
+                    island_settings['generations'] = min(island_settings['generations'], converged_generation + args['stagnation'] - gen)
+                current_time = time.time()
+                print 'Elapsed Time: %s' % (datetime.timedelta(seconds=int(current_time - start_time)))
+                print 'Running Generations #%d-#%d on %d islands' % (gen + 1, gen + island_settings['generations'], n_islands)
+                results = map_jobs_timed(pool.map, evolve_island, [(island, island_settings) for island in islands], timer)
+                islands = [result[0] for result in results]
+                # islands stop early at the deadline or the target fitness
+                gen += max(result[4] for result in results)
+                for island, scored, avoided, stats, generations, island_times in results:
+                    total_avoided += avoided
+                    if stats is not None:
+                        cache_stats[stats[0]] = stats[1:]
+                with timer.phase('migration'):
+                    islands = migrate(islands, args['migrants'], args['topology'])
+                population = concatenate_populations([island[0] for island in islands])
+                errors = np.concatenate([island[1] for island in islands])
+                fitnesses = np.concatenate([island[2] for island in islands])
+                print 'Divisions Scored: %d' % sum(result[1] for result in results)
+                print 'Min Fitness: %d' % min(fitnesses)
+                run_timer.merge(timer.totals)
+                write_generation_metrics(metrics, timer, gen, time.time() - current_time, population, fitnesses, sum(result[1] for result in results), answer_divisions.shape[1])
+                best = best_scored_row(errors, fitnesses)
+                if best is not None and fitnesses[best] < best_fitness:
+                    best_chromosome, best_fitness = population.take([best]), fitnesses[best]
+                    converged_generation = gen
+                stop_reason = termination_reason(args, start_time, gen, best_fitness, converged_generation)
+        else:
+            # run populations
+            stop_reason = termination_reason(args, start_time, gen, best_fitness, converged_generation)
+            while stop_reason is None:
+                current_time = time.time()
+                print 'Elapsed Time: %s' % (datetime.timedelta(seconds=int(current_time - start_time)))
+                print 'Running Generation #%d' % (gen+1)
+                with timer.phase('breeding'):
+                    new_population, new_errors = BreedGeneration(population, errors, fitnesses, select, n_elites, n_survivors, args['mutation_rate'], error_table is None, rng)
             
-            new_fitnesses = pool.map(partial(fitness, answer_audio=audio_data, byte_depth=byte_depth), new_test_datas)
+                # only re-score the divisions whose genes changed
+                estimates = np.full(len(new_population), -1, dtype=np.int64)
+                with timer.phase('scoring'):
+                    if error_table is not None:
+                        with timer.phase('fitness'):
+                            stale_divisions, avoided_divisions = table_errors(new_population, new_errors, error_table), 0
+                    else:
+                        stale_divisions, avoided_divisions = score_population(pool.map, score, new_population, new_errors, args['max_processes'], cache_stats, memo, pyramid, estimates, timer)
+                    fitnesses = population_fitnesses(new_errors, estimates, padding_error)
             
-            chromosomes = new_chromosomes
-            test_datas = new_test_datas
-            fitnesses = new_fitnesses
-            new_chromosomes = []
-            new_test_datas = []
-            new_fitnesses = []
-            print 'Min Fitness: %d' % min(fitnesses)
+                population = new_population
+                errors = new_errors
+                print 'Divisions Scored: %d of %d' % (stale_divisions, errors.size)
+                if pyramid:
+                    total_avoided += avoided_divisions
+                    print 'Full Resolution Divisions Avoided: %d of %d' % (avoided_divisions, avoided_divisions + stale_divisions)
+                print 'Min Fitness: %d' % min(fitnesses)
+                gen += 1
+                run_timer.merge(timer.totals)
+                write_generation_metrics(metrics, timer, gen, time.time() - current_time, population, fitnesses, stale_divisions, answer_divisions.shape[1])
+                best = best_scored_row(errors, fitnesses)
+                if best is not None and fitnesses[best] < best_fitness:
+                    best_chromosome, best_fitness = population.take([best]), fitnesses[best]
+                    converged_generation = gen
+                stop_reason = termination_reason(args, start_time, gen, best_fitness, converged_generation)
     except KeyboardInterrupt:
         print 'Keyboard Interrupt! Exiting!'
+        stop_reason = 'keyboard interrupt'
+    finally:
+        pool.terminate()
+        for answer_file in answer_files:
+            os.remove(answer_file)
+        
+    if best_chromosome is None:
+        print 'No chromosome was scored, nothing to export'
+        metrics.close()
+        stop_profile(profiler, args['profile'])
+        return
+    print 'Stopped: %s' % stop_reason
+    print 'Best Fitness: %d' % best_fitness
+    # render and fitness are the time of all processes added up
+    print 'Time Spent: %s' % ', '.join('%s %.2fs' % (name, seconds) for name, seconds in run_timer.totals.items())
+    metrics.write('run', generations=gen, stop_reason=stop_reason, best_fitness=best_fitness, converged_generation=converged_generation,
+                  seconds=time.time() - start_time, phases=run_timer.totals, peak_mb=peak_memory_mb(), worker_peak_mb=peak_memory_mb(children=True), notes=[note_index.letters[note] for note in best_chromosome.notes[0]])
+    metrics.close()
+    print 'Converged at Generation: %d (last improvement of the best fitness)' % converged_generation
+    if pyramid:
+        print 'Total Full Resolution Divisions Avoided: %d' % total_avoided
+    if memo is not None:
+        print 'Fitness Memo: %d chromosomes not scored again' % memo.hits
+    if analysis_cache is not None:
+        print 'Analysis Cache: %d hits, %d misses' % (analysis_cache.hits, analysis_cache.misses)
+    if cache_bytes > 0:
+        hits, misses, error_hits, error_misses, n_bytes, n_entries = [sum(s) for s in zip(*cache_stats.values())] or [0, 0, 0, 0, 0, 0]
+        print 'Segment Cache: %d hits, %d misses (%.1f%% hit rate)' % (hits, misses, 100.0 * hits / max(1, hits + misses))
+        if args['cache_errors']:
+            print 'Error Cache: %d hits, %d misses (%.1f%% hit rate)' % (error_hits, error_misses, 100.0 * error_hits / max(1, error_hits + error_misses))
+        print 'Segment Cache Memory: %.1f MB in %d entries over %d processes' % (n_bytes / (1024.0 * 1024.0), n_entries, len(cache_stats))
         
-    c = chromosomes[0]
-    final_audio = generate_random_audio(c, n_samples=n_frames, sample_rate=framerate, byte_depth=byte_depth, n_channels=n_channels, bpm=bpm, division=divisions)
+    c = best_chromosome.chromosome(0)
+    if cache_bytes > 0:
+        c = quantize_chromosome(c, args['phase_steps'])
+    audio_blocks = partial(chromosome_audio_blocks, c, n_samples=n_frames, sample_rate=framerate, byte_depth=byte_depth, n_channels=n_channels, bpm=bpm, division=divisions, block_frames=args['block_frames'])
+    if error_table is not None:
+        # for comparison with runs using the time domain fitness
+        print 'Time Domain Fitness: %d' % blocks_fitness(audio_blocks(), audio_data, byte_depth)
     
     print 'Done!'
     print 'Notes:',
-    for gene in c:
-        print frequencies.keys()[frequencies.values().index(gene[0])],
+    for letter in note_index.letters_of([gene[0] for gene in c]):
+        print letter,
     print ''
-    export_audio = ConvertBackToSamples(final_audio)
-    export_wave_file = wave.open('export.wav', 'w')
-    export_wave_file.setnchannels(n_channels)
-    export_wave_file.setsampwidth(byte_depth)
-    export_wave_file.setframerate(framerate)
-    export_wave_file.writeframesraw(export_audio)
+    write_wave(args['output_file'], audio_blocks(), n_frames, n_channels, byte_depth, framerate)
+    stop_profile(profiler, args['profile'])
     
 if __name__ == "__main__":
     RunGenerations()
\ No newline at end of file
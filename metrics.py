@@ -0,0 +1,129 @@
+# Timing and metrics for the fft and genetic pipelines
+# Shared by fft.py and generation.py, so it runs under Python 2 and 3
+
+from __future__ import division, print_function
+import sys
+import time
+import json
+import cProfile
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Wall clock seconds spent in named phases. Phases nest, and the time spent in an inner
+# phase only counts for the inner one, so the totals add up to the time measured
+class PhaseTimer(object):
+    def __init__(self):
+        self.totals = OrderedDict()
+        # seconds spent in the nested phases of every open phase
+        self.nested = []
+
+    @contextmanager
+    def phase(self, name):
+        self.nested.append(0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.add(name, elapsed - self.nested.pop())
+            if self.nested:
+                self.nested[-1] += elapsed
+
+    # function that calls function in phase name
+    def timed(self, name, function):
+        def timed_function(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return timed_function
+
+    # yields the items of iterable, producing each one in phase name
+    def timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    # adds the totals of another timer, e.g. one that ran in a worker process
+    def merge(self, totals):
+        for name, seconds in totals.items():
+            self.add(name, seconds)
+
+    # returns the totals so far and starts again from zero
+    def reset(self):
+        totals = self.totals
+        self.totals = OrderedDict()
+        return totals
+
+# min, mean and max of an array of values
+def summary(values):
+    values = np.asarray(values)
+    return OrderedDict([('min', values.min()), ('mean', values.mean()), ('max', values.max())])
+
+# numpy scalars and arrays as plain JSON values
+def json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value.item()
+
+# Writes metrics records as JSON lines, one per event, to a file (nothing without a file name)
+class MetricsWriter(object):
+    def __init__(self, file_name=None):
+        self.file = open(file_name, 'w') if file_name is not None else None
+
+    def write(self, event, **fields):
+        if self.file is None:
+            return
+        record = OrderedDict([('event', event), ('time', time.time())])
+        record.update(sorted(fields.items()))
+        self.file.write(json.dumps(record, default=json_default) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# Peak resident memory of this process in MB, None where it cannot be told. Read from /proc
+# where there is one, as ru_maxrss also counts the memory of the process that started this one.
+# With children, the peak of the largest child that has been waited for
+def peak_memory_mb(children=False):
+    if not children:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024.0
+        except IOError:
+            pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return max_rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+# A running profiler if profile_file is given, else None
+def start_profile(profile_file):
+    if profile_file is None:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+# Stops a profiler from start_profile and dumps its stats (readable with pstats) to profile_file
+def stop_profile(profiler, profile_file):
+    if profiler is None:
+        return
+    profiler.disable()
+    profiler.dump_stats(profile_file)